@@ -1,9 +1,97 @@
+import base64
+import errno
+import hashlib
+import json
+import os
+import pwd
+import re
+import tempfile
+
 from ipaclient.frontend import MethodOverride
+from ipalib import _, errors, output
+from ipalib import Flag, Int, Str
+from ipalib.frontend import Local
 from ipalib.parameters import File
 from ipalib.plugable import Registry
 
 register = Registry()
 
+# Version of the line-delimited desktop profile archive format
+ARCHIVE_VERSION = 1
+
+# Number of entries exchanged with the server in a single call
+BATCH_SIZE = 500
+
+# Order in which entries are written to an archive: rules refer to
+# profiles, so profiles have to be restored first
+EXPORT_TYPES = (
+    (u'config', None),
+    (u'profile', 'deskprofile_find'),
+    (u'rule', 'deskprofilerule_find'),
+)
+
+# Location where FleetCommander agent picks up profiles of the users
+FLEETCMD_DIR = '/var/lib/sss/fleetcmd'
+
+# Names of the profile files managed in a user directory
+PROFILE_FILE_RE = re.compile(r'^[0-9]{6}_.+\.json$')
+
+
+def _profile_file_name(priority, rule):
+    """
+    Build a profile file name the way SSSD does: a zero-padded priority
+    followed by the rule name with shell globbing characters removed and
+    whitespace replaced by underscores.
+    """
+    name = re.sub(r'[*?\[\]{}/\\]', '', rule)
+    name = re.sub(r'\s', '_', name)
+    return '%06d_%s.json' % (priority, name)
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return _digest(f.read())
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def _write_atomic(path, data, owner):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.',
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if owner is not None:
+            os.chown(tmp, owner.pw_uid, owner.pw_gid)
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _write_record(f, record):
+    if 'ipadeskdata' in record:
+        record = dict(record)
+        record['ipadeskdata'] = base64.b64encode(
+            record['ipadeskdata']).decode('ascii')
+    f.write((json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+
+
+def _read_record(line):
+    record = json.loads(line.decode('utf-8'))
+    if 'ipadeskdata' in record:
+        record['ipadeskdata'] = base64.b64decode(record['ipadeskdata'])
+    return record
+
 
 @register(override=True, no_fail=True)
 class deskprofile_add(MethodOverride):
@@ -29,3 +117,278 @@ class deskprofile_mod(MethodOverride):
             if opt.name == 'ipadeskdata' and self.env.interactive:
                 opt = opt.clone_retype(opt.name, File)
             yield opt
+
+
+@register()
+class deskprofile_export(Local):
+    __doc__ = _('Export Desktop Profiles, Rule Maps and configuration '
+                'to a file.')
+
+    takes_options = (
+        Str('out',
+            cli_name='out',
+            label=_('Output file'),
+            doc=_('File to store the exported entries'),
+        ),
+        Int('batch_size?',
+            cli_name='batch_size',
+            label=_('Batch size'),
+            doc=_('Number of entries requested from the server at once'),
+            minvalue=1,
+            default=BATCH_SIZE,
+            autofill=True,
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict,
+                      _('Number of exported entries per type')),
+        output.Output('count', int, _('Number of exported entries')),
+    )
+
+    msg_summary = _('Exported %(count)d entries')
+
+    def forward(self, *args, **options):
+        batch_size = options.get('batch_size') or BATCH_SIZE
+        counts = {}
+
+        # Entries are fetched and written one batch at a time so that
+        # only a single batch and the list of names are held in memory
+        with open(options['out'], 'wb') as f:
+            _write_record(f, dict(type=u'header', version=ARCHIVE_VERSION))
+            for export_type, find_command in EXPORT_TYPES:
+                counts[export_type] = 0
+                if find_command is None:
+                    batches = [None]
+                else:
+                    # A partial list of names would give a partial archive
+                    result = self.api.Command[find_command](
+                        pkey_only=True, sizelimit=0, timelimit=0)
+                    if result['truncated']:
+                        raise errors.LimitsExceeded()
+                    names = [entry['cn'][0] for entry in result['result']]
+                    batches = [names[i:i + batch_size]
+                               for i in range(0, len(names), batch_size)]
+
+                for names in batches:
+                    kw = dict(type=export_type)
+                    if names is not None:
+                        kw['names'] = names
+                    records = self.api.Command.deskprofile_export_internal(
+                        **kw)['result']
+                    for record in records:
+                        _write_record(f, record)
+                    counts[export_type] += len(records)
+
+        return dict(result=counts, count=sum(counts.values()))
+
+
+@register()
+class deskprofile_import(Local):
+    __doc__ = _('Import Desktop Profiles, Rule Maps and configuration '
+                'from a file.')
+
+    takes_options = (
+        Str('in',
+            cli_name='in',
+            label=_('Input file'),
+            doc=_('File with entries created by deskprofile-export'),
+        ),
+        Int('batch_size?',
+            cli_name='batch_size',
+            label=_('Batch size'),
+            doc=_('Number of entries sent to the server at once'),
+            minvalue=1,
+            default=BATCH_SIZE,
+            autofill=True,
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict,
+                      _('Number of imported entries per type')),
+        output.Output('failed', (list, tuple),
+                      _('Entries that could not be imported')),
+        output.Output('count', int, _('Number of imported entries')),
+    )
+
+    msg_summary = _('Imported %(count)d entries')
+
+    def forward(self, *args, **options):
+        batch_size = options.get('batch_size') or BATCH_SIZE
+        counts = dict(config=0, profile=0, rule=0)
+        failed = []
+
+        def flush(batch):
+            result = self.api.Command.deskprofile_import_internal(
+                records=batch)
+            for key, value in result['result'].items():
+                counts[key] = counts.get(key, 0) + value
+            failed.extend(result['failed'])
+
+        with open(options['in'], 'rb') as f:
+            header = _read_record(f.readline() or b'{}')
+            if header.get('type') != u'header' or \
+                    header.get('version') != ARCHIVE_VERSION:
+                raise errors.ValidationError(
+                    name='in',
+                    error=_('not a desktop profile archive'))
+
+            batch = []
+            for line in f:
+                if not line.strip():
+                    continue
+                batch.append(_read_record(line))
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+
+        return dict(result=counts, failed=failed,
+                    count=sum(counts.values()))
+
+
+@register()
+class deskprofile_stage(Local):
+    __doc__ = _('Write the Desktop Profiles applied to users on a host '
+                'into the directory tree used by FleetCommander.')
+
+    takes_options = (
+        Str('host?',
+            cli_name='host',
+            label=_('Host'),
+            doc=_('Host to stage the profiles for (default: this host)'),
+        ),
+        Str('user*',
+            cli_name='users',
+            label=_('Users'),
+            doc=_('Users to stage the profiles for (default: all users '
+                  'the rules of the host apply to)'),
+        ),
+        Str('container*',
+            cli_name='containers',
+            label=_('Rule containers'),
+            doc=_('Search only the top-level container and these rule '
+                  'containers (default: all rules)'),
+        ),
+        Str('directory?',
+            cli_name='directory',
+            label=_('Directory'),
+            doc=_('Top-level directory of the profile tree'),
+            default=FLEETCMD_DIR,
+            autofill=True,
+        ),
+        Flag('no_chown',
+            cli_name='no_chown',
+            doc=_('Do not change ownership of the user directories '
+                  'and files'),
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict,
+                      _('Number of written, unchanged and removed files')),
+        output.Output('count', int, _('Number of changed files')),
+        output.Output('failed', (list, tuple),
+                      _('Users the rules were not resolved for')),
+    )
+
+    msg_summary = _('Changed %(count)d profile files')
+
+    def forward(self, *args, **options):
+        host = options.get('host') or self.api.env.host
+        top = options.get('directory') or FLEETCMD_DIR
+        chown = not options.get('no_chown') and os.geteuid() == 0
+
+        kw = dict(host=host)
+        if options.get('user'):
+            kw['user'] = options['user']
+        if options.get('container'):
+            kw['container'] = options['container']
+        resolved = self.api.Command.deskprofilerule_resolve(**kw)['result']
+        rules = resolved['rules']
+        profiles = resolved['profiles']
+        user_rules = {}
+        for policy_id in resolved['hosts'].values():
+            user_rules.update(resolved['policies'][policy_id])
+
+        # Requested names are matched against the canonical names returned
+        # by the server. Users the server did not return are left alone
+        # rather than having their profiles removed.
+        failed = []
+        if options.get('user'):
+            known = dict((uid.lower(), uid) for uid in user_rules)
+            users = []
+            for name in options['user']:
+                uid = known.get(name.lower())
+                if uid is None:
+                    failed.append(name)
+                elif uid not in users:
+                    users.append(uid)
+        else:
+            users = sorted(user_rules)
+
+        counts = dict(written=0, unchanged=0, removed=0)
+        for user in users:
+            files = {}
+            for rule in user_rules.get(user, []):
+                data = profiles.get(rules[rule]['profile'])
+                if data is not None:
+                    name = _profile_file_name(rules[rule]['priority'], rule)
+                    files[name] = data
+            self._stage_user(os.path.join(top, user), user, files, chown,
+                             counts)
+
+        # Users who are no longer in scope of the rules of the host lose
+        # their profiles when all users are staged. Rules of other rule
+        # containers may still apply to users missing from a search
+        # limited to some containers.
+        if not options.get('user') and not options.get('container') and \
+                os.path.isdir(top):
+            staged = set(user.lower() for user in users)
+            for name in os.listdir(top):
+                path = os.path.join(top, name)
+                if name.lower() in staged or os.path.islink(path) or \
+                        not os.path.isdir(path):
+                    continue
+                self._remove_stale(path, {}, counts)
+
+        return dict(result=counts,
+                    count=counts['written'] + counts['removed'],
+                    failed=failed)
+
+    def _stage_user(self, path, user, files, chown, counts):
+        owner = None
+        if chown:
+            try:
+                owner = pwd.getpwnam(user)
+            except KeyError:
+                pass
+
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+            if owner is not None:
+                os.chown(path, owner.pw_uid, owner.pw_gid)
+
+        # Only files whose content changed are rewritten
+        for name, data in files.items():
+            target = os.path.join(path, name)
+            if _file_digest(target) == _digest(data):
+                counts['unchanged'] += 1
+                continue
+            _write_atomic(target, data, owner)
+            counts['written'] += 1
+
+        self._remove_stale(path, files, counts)
+
+    def _remove_stale(self, path, files, counts):
+        for name in os.listdir(path):
+            target = os.path.join(path, name)
+            if PROFILE_FILE_RE.match(name) and name not in files and \
+                    not os.path.islink(target):
+                os.unlink(target)
+                counts['removed'] += 1
@@ -4,10 +4,16 @@
 # Copyright (C) 2016  Red Hat
 # see file 'COPYING' for use and warranty information
 
+import hashlib
+import json
 import re
+from collections import OrderedDict
+
+import six
 
 from ipalib import api, errors
-from ipalib import Str, StrEnum, Bool, Bytes, Int
+from ipalib import Command, Flag, Str, StrEnum, Bool, Bytes, Int
+from ipalib.parameters import Dict
 from ipalib.plugable import Registry
 from .baseldap import (
     pkey_to_value,
@@ -19,12 +25,16 @@ from .baseldap import (
     LDAPRetrieve,
     LDAPQuery,
     LDAPAddMember,
-    LDAPRemoveMember)
+    LDAPRemoveMember,
+    entry_to_dict)
 from ipalib import _, ngettext
 from ipalib import output
 from .hbacrule import is_all
 from ipapython.dn import DN
 
+if six.PY3:
+    unicode = str
+
 __doc__ = _("""
 Desktop profile mapping
 
@@ -36,6 +46,16 @@ A desktop profile is a set of configuration settings enforced by
 FleetCommander.  The profiles are stored by IPA and can be associated with
 hosts, hostgroups, users, and groups by creating a mapping rule.
 
+A desktop profile may extend a parent profile and specify only the changes
+to it. The profile stores the data composed from all parents, so clients
+receive the complete profile, and the data is composed again whenever a
+parent changes.
+
+Rules may be kept in rule containers below the top-level rule container,
+for example one per location or per top-level hostgroup, so that queries
+for a single host only search the containers it needs. Rule names are
+unique across all rule containers.
+
 Hosts, hostgroups, users and groups can be either defined within
 the rule or it may point to an existing HBAC rule. When using
 --hbacrule option to deskprofilerule-find an exact match is made on the
@@ -82,6 +102,61 @@ Display the properties of a desktop profile:
  Remove a profile:
    ipa deskprofile-del "Visual Design"
 
+ Create a desktop profile, "finance-laptops", which only stores changes
+ to the "finance" desktop profile:
+   ipa deskprofile-add finance-laptops --parent=finance --data=laptops.json
+
+ Display the data stored in a layered desktop profile without its parents:
+   ipa deskprofile-show finance-laptops --delta
+
+ Show which rules and profiles apply to users "bob" and "alice" on host "a1":
+   ipa deskprofilerule-resolve --host=a1 --users={bob,alice}
+
+ Resolve rules and profiles for all users on all hosts of host group "lab":
+   ipa deskprofilerule-resolve --hostgroup=lab
+
+ Write the profiles of users "bob" and "alice" on this host into
+ /var/lib/sss/fleetcmd, rewriting only the files that changed:
+   ipa deskprofile-stage --users={bob,alice}
+
+ Pre-stage the profiles of all users the rules of this host apply to:
+   ipa deskprofile-stage
+
+ Display the number of users, groups, hosts and host groups of a rule:
+   ipa deskprofilerule-show finance --summary
+
+ List the first 100 users of a rule whose names contain "smith":
+   ipa deskprofilerule-member-find finance --type=user --criteria=smith --limit=100
+
+ Report rules that never contribute to applied profiles and rules applying
+ different profiles at the same priority to the same members:
+   ipa deskprofilerule-analyze
+
+ Create a rule kept in the rule container "berlin":
+   ipa deskprofilerule-add berlin-kiosk --profile=kiosk --prio=100 --container=berlin
+
+ Move an existing rule to the rule container "berlin":
+   ipa deskprofilerule-mod finance --container=berlin
+
+ Show the rules kept in the rule container "berlin":
+   ipa deskprofilerule-find --container=berlin
+
+ Resolve rules for host "a1" from the top-level and "berlin" containers only:
+   ipa deskprofilerule-resolve --host=a1 --containers=berlin
+
+ Move rules into rule containers named after the top-level hostgroup of
+ their hosts:
+   ipa deskprofilerule-redistribute
+
+ Move all rules back to the top-level rule container:
+   ipa deskprofilerule-redistribute --flatten
+
+ Export all desktop profiles, rules and the global policy to a file:
+   ipa deskprofile-export --out=desktop-profiles.jsonl
+
+ Import desktop profiles, rules and the global policy from an export:
+   ipa deskprofile-import --in=desktop-profiles.jsonl
+
  To define global policy on how profile apply:
    ipa deskprofileconfig-mod --priority=NUMBER
 
@@ -122,6 +197,338 @@ PLUGIN_CONFIG = (
     ('container_deskprofilerule', DN(('cn', 'rules'), ('cn', 'desktop-profile'))),
 )
 
+# Number of names combined into a single LDAP search filter
+SEARCH_CHUNK_SIZE = 500
+
+# Number of member values added to a rule with a single modification
+MODIFY_CHUNK_SIZE = 1000
+
+# Maximum number of parents a layered desktop profile may have
+MAX_PROFILE_DEPTH = 16
+
+# Number of composed layered desktop profiles kept in memory
+COMPOSED_CACHE_SIZE = 256
+
+# Composed data of layered profiles keyed by the digests of their layers
+_composed_profiles = OrderedDict()
+
+# Attributes of a rule needed to decide whom it applies to
+RESOLVE_ATTRIBUTES = [
+    'cn', 'ipadeskprofiletarget', 'ipadeskprofilepriority', 'seealso',
+    'usercategory', 'memberuser', 'hostcategory', 'memberhost',
+]
+
+# Member attributes of a rule split by member type
+RULE_MEMBER_ATTRIBUTES = (
+    'memberuser_user', 'memberuser_group',
+    'memberhost_host', 'memberhost_hostgroup',
+)
+
+
+def _merge_profile_data(base, delta):
+    """
+    Merge a JSON document of a profile layer into the document composed
+    from its parents. Objects are merged recursively and a null value
+    removes the key. Lists of settings identified by 'key' are merged by
+    that key, any other value of the layer replaces the parent one.
+    """
+    if isinstance(delta, dict):
+        merged = dict(base) if isinstance(base, dict) else {}
+        for key, value in delta.items():
+            if value is None:
+                merged.pop(key, None)
+            else:
+                merged[key] = _merge_profile_data(merged.get(key), value)
+        return merged
+
+    is_keyed = lambda items: all(
+        isinstance(item, dict) and 'key' in item for item in items)
+    if isinstance(base, list) and isinstance(delta, list) and \
+            is_keyed(base) and is_keyed(delta):
+        merged = list(base)
+        index = dict((item['key'], i) for i, item in enumerate(merged))
+        for item in delta:
+            if item['key'] in index:
+                merged[index[item['key']]] = item
+            else:
+                index[item['key']] = len(merged)
+                merged.append(item)
+        return merged
+
+    return delta
+
+
+def _compose_profile_data(layers):
+    """
+    Compose profile data out of layers ordered from the topmost parent
+    to the profile itself. Results are cached by the digests of the
+    layers, so a profile is only composed again when one of its layers
+    changes.
+    """
+    key = tuple(hashlib.sha256(layer).hexdigest() for layer in layers)
+    try:
+        data = _composed_profiles.pop(key)
+    except KeyError:
+        document = None
+        try:
+            for layer in layers:
+                document = _merge_profile_data(
+                    document, json.loads(layer.decode('utf-8')))
+        except (ValueError, UnicodeDecodeError):
+            raise errors.ValidationError(
+                name='ipadeskdata',
+                error=_('layered profile data must be a JSON document'))
+        data = json.dumps(document, sort_keys=True).encode('utf-8')
+        while len(_composed_profiles) >= COMPOSED_CACHE_SIZE:
+            _composed_profiles.popitem(last=False)
+    _composed_profiles[key] = data
+    return data
+
+
+def _rule_covers(wider, rule):
+    """
+    Check whether a rule applies to every user and host another rule
+    applies to.
+    """
+    return (wider['user_all'] or
+            (not rule['user_all'] and rule['users'] <= wider['users'])) and \
+           (wider['host_all'] or
+            (not rule['host_all'] and rule['hosts'] <= wider['hosts']))
+
+
+def _index_keys(rule):
+    """
+    Keys under which a rule is indexed to find the rules it may cover:
+    member DNs qualified by the categories of the rule.
+    """
+    if rule['user_all'] and rule['host_all']:
+        return [(u'universal', None)]
+    if rule['user_all']:
+        return [(u'user_all', dn) for dn in rule['hosts']]
+    if rule['host_all']:
+        return [(u'host_all', dn) for dn in rule['users']]
+    return [(u'users', dn) for dn in rule['users']] + \
+           [(u'hosts', dn) for dn in rule['hosts']]
+
+
+def _covering_candidates(index, rule):
+    """
+    Return indexes of rules which may cover a rule in the order they
+    were indexed. A rule covering another one has the categories of the
+    rule and all its member DNs, so the shortest index bucket of a
+    single member DN is enough to find it.
+    """
+    def shortest(kind, dns):
+        return min((index.get((kind, dn), []) for dn in dns), key=len)
+
+    options = []
+    if not rule['user_all'] and not rule['host_all']:
+        options.append(min(shortest(u'users', rule['users']),
+                           shortest(u'hosts', rule['hosts']), key=len))
+    if not rule['host_all']:
+        options.append(shortest(u'user_all', rule['hosts']))
+    if not rule['user_all']:
+        options.append(shortest(u'host_all', rule['users']))
+    options.append(index.get((u'universal', None), []))
+    return sorted(set(i for option in options for i in option))
+
+
+def _join_different(bucket, rules, others, union):
+    """
+    Join every rule with the other rules applying another profile. Each
+    rule is joined with the first rules of up to three profiles among
+    the others, which connects the same groups as joining all pairs.
+    """
+    firsts = OrderedDict()
+    for i in others:
+        firsts.setdefault(bucket[i]['profile'], i)
+    firsts = list(firsts.values())[:3]
+    for i in rules:
+        for j in firsts:
+            if bucket[i]['profile'] != bucket[j]['profile']:
+                union(i, j)
+
+
+def _analyze_rules(rules):
+    """
+    Find rules which never contribute to the profiles applied to users.
+
+    Each rule is a dictionary with the name, enabled state, profile and
+    priority of the rule, whether its users and hosts are defined by a
+    missing HBAC rule, category flags and sets of direct member DNs.
+    Group memberships are not expanded, so only rules shadowed by their
+    direct members are reported.
+    """
+    report = dict(unreachable=[], duplicates=[], shadowed=[], conflicts=[])
+
+    reachable = []
+    for rule in sorted(rules, key=lambda rule: rule['name'].lower()):
+        if not rule['enabled']:
+            reason = u'disabled'
+        elif rule['hbac_missing']:
+            reason = u'HBAC rule not found'
+        elif not rule['user_all'] and not rule['users']:
+            reason = u'no users'
+        elif not rule['host_all'] and not rule['hosts']:
+            reason = u'no hosts'
+        else:
+            reachable.append(rule)
+            continue
+        report['unreachable'].append(dict(rule=rule['name'], reason=reason))
+
+    # Rules applying the same profile at the same priority to the same
+    # members: all but the first one can be removed
+    unique = {}
+    for rule in reachable:
+        key = (rule['profile'], rule['priority'],
+               rule['user_all'], rule['users'],
+               rule['host_all'], rule['hosts'])
+        if key in unique:
+            report['duplicates'].append(dict(
+                rule=rule['name'], duplicate_of=unique[key]['name']))
+        else:
+            unique[key] = rule
+
+    # A rule applying the same profile at the same priority to a subset
+    # of the members of another rule adds nothing. Wider rules are
+    # visited first, so a rule is only reported as shadowed by a rule
+    # which is kept. Kept rules which may cover a rule are looked up
+    # through indexes of their member DNs.
+    groups = {}
+    for rule in unique.values():
+        groups.setdefault((rule['profile'], rule['priority']), []).append(rule)
+    effective = []
+    for group in groups.values():
+        group.sort(key=lambda rule: (
+            not rule['user_all'], -len(rule['users']),
+            not rule['host_all'], -len(rule['hosts']),
+            rule['name'].lower()))
+        kept = []
+        index = {}
+        for rule in group:
+            for i in _covering_candidates(index, rule):
+                if _rule_covers(kept[i], rule):
+                    report['shadowed'].append(dict(
+                        rule=rule['name'], shadowed_by=kept[i]['name']))
+                    break
+            else:
+                for key in _index_keys(rule):
+                    index.setdefault(key, []).append(len(kept))
+                kept.append(rule)
+        effective.extend(kept)
+
+    # Rules applying different profiles at the same priority to
+    # overlapping members are reported as groups of rules connected by
+    # such overlaps. Rules sharing a member DN are joined per bucket of
+    # the member DN indexes rather than compared pair by pair.
+    buckets = {}
+    for rule in effective:
+        buckets.setdefault(rule['priority'], []).append(rule)
+    for priority in sorted(buckets):
+        bucket = sorted(buckets[priority], key=lambda rule: rule['name'].lower())
+        if len(set(rule['profile'] for rule in bucket)) < 2:
+            continue
+
+        parent = list(range(len(bucket)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        conflicting = set()
+
+        def union(i, j):
+            conflicting.update((i, j))
+            parent[find(i)] = find(j)
+
+        def join(members, wide=None):
+            # Join rules which all overlap with each other, or with the
+            # rules for all users or hosts among them, if any of them
+            # apply another profile
+            if wide is None:
+                wide = members
+            profiles = set(bucket[i]['profile'] for i in wide)
+            if len(profiles) > 1:
+                joined = members
+            else:
+                joined = [i for i in members
+                          if bucket[i]['profile'] not in profiles]
+                if not joined:
+                    return
+                joined.extend(wide)
+            for i in joined:
+                union(joined[0], i)
+
+        kinds = dict(universal=[], user_all=[], host_all=[], members=[])
+        for i, rule in enumerate(bucket):
+            if rule['user_all'] and rule['host_all']:
+                kinds['universal'].append(i)
+            elif rule['user_all']:
+                kinds['user_all'].append(i)
+            elif rule['host_all']:
+                kinds['host_all'].append(i)
+            else:
+                kinds['members'].append(i)
+
+        # Rules for all users on all hosts overlap with every rule, so
+        # every rule with another profile joins their group
+        if kinds['universal']:
+            join(list(range(len(bucket))), kinds['universal'])
+
+        # Rules for all users overlap with every rule for all hosts
+        _join_different(bucket, kinds['user_all'], kinds['host_all'], union)
+        _join_different(bucket, kinds['host_all'], kinds['user_all'], union)
+
+        # Rules for all users overlap with every rule on one of their
+        # hosts, rules for all hosts with every rule for one of their users
+        for side, kind in (('hosts', 'user_all'), ('users', 'host_all')):
+            index = {}
+            for i in kinds[kind] + kinds['members']:
+                for dn in bucket[i][side]:
+                    index.setdefault(dn, []).append(i)
+            for members in index.values():
+                wide = [i for i in members if bucket[i][kind]]
+                if wide:
+                    join(members, wide)
+
+        # Rules listing both users and hosts overlap when they share a
+        # user and a host. Rules sharing a user are matched by hosts once
+        # per distinct set of such rules.
+        index = {}
+        for i in kinds['members']:
+            for dn in bucket[i]['users']:
+                index.setdefault(dn, []).append(i)
+        seen = set()
+        for members in index.values():
+            if len(members) < 2 or tuple(members) in seen:
+                continue
+            seen.add(tuple(members))
+            if len(set(bucket[i]['profile'] for i in members)) < 2 or \
+                    len(set(find(i) for i in members)) < 2:
+                continue
+            # Hosts of the rule with the most hosts are only looked up
+            members = sorted(members, key=lambda i: len(bucket[i]['hosts']))
+            largest = members.pop()
+            cells = {}
+            for i in members:
+                for dn in bucket[i]['hosts']:
+                    cells.setdefault(dn, []).append(i)
+            for dn, cell in cells.items():
+                if dn in bucket[largest]['hosts']:
+                    cell.append(largest)
+                if len(cell) > 1:
+                    join(cell)
+
+        groups = {}
+        for i in sorted(conflicting):
+            groups.setdefault(find(i), []).append(bucket[i]['name'])
+        for names in sorted(groups.values()):
+            report['conflicts'].append(dict(priority=priority, rules=names))
+
+    return report
+
 
 @register()
 class deskprofile(LDAPObject):
@@ -134,11 +541,11 @@ class deskprofile(LDAPObject):
     object_class = ['ipaassociation', 'ipadeskprofile']
     permission_filter_objectclasses = ['ipadeskprofile']
     default_attributes = [
-        'cn', 'ipadeskdata',
-        'description', 
+        'cn', 'ipadeskdata', 'ipadesklayerdata',
+        'description', 'ipadeskprofileparent',
     ]
     search_display_attributes = [
-        'cn', 'description',
+        'cn', 'description', 'ipadeskprofileparent',
     ]
     uuid_attribute = 'ipauniqueid'
     allow_rename = True
@@ -156,10 +563,17 @@ class deskprofile(LDAPObject):
             'ipapermbindruletype': 'permission',
             'ipapermright': {'read'},
             'ipapermdefaultattr': {
-                'ipadeskdata'
+                'ipadeskdata', 'ipadesklayerdata',
             },
             'default_privileges': {'FleetCommander Desktop Profile Administrators'},
         },
+        'System: Read FleetCommander Desktop Profile Parent': {
+            'ipapermbindruletype': 'all',
+            'ipapermright': {'read', 'search', 'compare'},
+            'ipapermdefaultattr': {
+                'ipadeskprofileparent',
+            },
+        },
         'System: Add FleetCommander Desktop Profile': {
             'ipapermbindruletype': 'permission',
             'ipapermright': {'add'},
@@ -170,6 +584,7 @@ class deskprofile(LDAPObject):
             'ipapermright': {'write'},
             'ipapermdefaultattr': {
                 'cn', 'ipadeskdata', 'description',
+                'ipadeskprofileparent', 'ipadesklayerdata',
             },
             'default_privileges': {'FleetCommander Desktop Profile Administrators'},
         },
@@ -197,6 +612,11 @@ class deskprofile(LDAPObject):
             cli_name='data',
             label=_('JSON data for profile'),
         ),
+        Str('ipadeskprofileparent?',
+            cli_name='parent',
+            label=_('Parent profile'),
+            doc=_('Desktop profile extended by the data of this profile'),
+        ),
     )
 
     # Inject constants into the api.env before it is locked down
@@ -205,12 +625,147 @@ class deskprofile(LDAPObject):
         self.container_dn = self.env.container_deskprofile
         super(deskprofile, self)._on_finalize()
 
+    def _normalize_parent(self, ldap, dn, parent):
+        """
+        Given a parent Desktop Profile name verify its existence, make
+        sure it does not lead back to the profile and return the dn.
+        """
+        if not parent:
+            return None
+
+        parent_dn = self.get_dn(parent)
+        seen = set([dn])
+        current = parent_dn
+        for depth in range(MAX_PROFILE_DEPTH):
+            if current in seen:
+                raise errors.ValidationError(
+                    name='ipadeskprofileparent',
+                    error=_('profile cannot extend itself'))
+            seen.add(current)
+            try:
+                entry_attrs = ldap.get_entry(current, ['ipadeskprofileparent'])
+            except errors.NotFound:
+                raise errors.NotFound(
+                    reason=_('Desktop profile %(rule)s not found')
+                    % dict(rule=current[0].value))
+            if 'ipadeskprofileparent' not in entry_attrs:
+                return parent_dn
+            current = DN(entry_attrs.single_value['ipadeskprofileparent'])
+
+        raise errors.ValidationError(
+            name='ipadeskprofileparent',
+            error=_('too many levels of parent profiles'))
+
+    def _validate_layer(self, data):
+        """
+        Data of a profile extending another one is merged with the parent
+        data and has to be a JSON document.
+        """
+        try:
+            json.loads(data.decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            raise errors.ValidationError(
+                name='ipadeskdata',
+                error=_('must be a JSON document when a parent profile '
+                        'is set'))
+
+    def _compose_data(self, ldap, layer, parent_dn):
+        """
+        Compose the effective data of a profile out of its own changes and
+        the effective data stored in its parent.
+        """
+        entry_attrs = ldap.get_entry(parent_dn, ['ipadeskdata'])
+        if 'ipadeskdata' not in entry_attrs:
+            raise errors.ACIError(
+                info=_('Insufficient access to read data of desktop '
+                       'profile %(name)s') % dict(name=parent_dn[0].value))
+        return _compose_profile_data(
+            [entry_attrs.single_value['ipadeskdata'], layer])
+
+    def _find_children(self, ldap, dn, attrs_list):
+        """
+        Find the profiles directly extending a profile
+        """
+        try:
+            entries, truncated = ldap.find_entries(
+                ldap.make_filter_from_attr('ipadeskprofileparent', dn),
+                attrs_list, DN(self.container_dn, api.env.basedn),
+                scope=ldap.SCOPE_ONELEVEL)
+        except errors.NotFound:
+            return []
+        return entries
+
+    def _store_composed(self, ldap, entry_attrs):
+        """
+        Store the changes of a layered profile merged with the effective
+        data of its parent.
+        """
+        entry_attrs['ipadeskdata'] = [self._compose_data(
+            ldap, entry_attrs.single_value['ipadesklayerdata'],
+            DN(entry_attrs.single_value['ipadeskprofileparent']))]
+        try:
+            ldap.update_entry(entry_attrs)
+        except errors.EmptyModlist:
+            pass
+
+    def _update_children(self, ldap, dn):
+        """
+        Compose again the data of all profiles extending a profile
+        directly or indirectly after the profile changed. Every profile
+        is composed after its parent.
+        """
+        attrs_list = ['ipadeskdata', 'ipadesklayerdata',
+                      'ipadeskprofileparent']
+        pending = [dn]
+        seen = set(pending)
+        while pending:
+            for child in self._find_children(ldap, pending.pop(), attrs_list):
+                if child.dn in seen or 'ipadesklayerdata' not in child:
+                    continue
+                seen.add(child.dn)
+                self._store_composed(ldap, child)
+                pending.append(child.dn)
+
+    def _convert_data(self, ldap, entry_attrs, **options):
+        """
+        Replace the effective data of a layered profile with its own
+        changes when requested and convert the parent Desktop Profile dn
+        into a name
+        """
+        layer = entry_attrs.pop('ipadesklayerdata', None)
+        if 'ipadeskprofileparent' not in entry_attrs:
+            return
+
+        if options.get('delta', False) and layer:
+            entry_attrs['ipadeskdata'] = layer
+
+        if not options.get('raw', False):
+            parent_dn = DN(entry_attrs.single_value['ipadeskprofileparent'])
+            entry_attrs['ipadeskprofileparent'] = parent_dn[0].value
+
 @register()
 class deskprofile_add(LDAPCreate):
     __doc__ = _('Create a new Desktop Profile.')
 
     msg_summary = _('Added Desktop Profile "%(value)s"')
 
+    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+        assert isinstance(dn, DN)
+        if entry_attrs.get('ipadeskprofileparent'):
+            entry_attrs['ipadeskprofileparent'] = self.obj._normalize_parent(
+                ldap, dn, entry_attrs['ipadeskprofileparent'])
+            self.obj._validate_layer(entry_attrs['ipadeskdata'])
+            entry_attrs['ipadesklayerdata'] = entry_attrs['ipadeskdata']
+            entry_attrs['ipadeskdata'] = self.obj._compose_data(
+                ldap, entry_attrs['ipadesklayerdata'],
+                entry_attrs['ipadeskprofileparent'])
+        return dn
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        assert isinstance(dn, DN)
+        self.obj._convert_data(ldap, entry_attrs, **options)
+        return dn
+
 
 
 @register()
@@ -219,6 +774,15 @@ class deskprofile_del(LDAPDelete):
 
     msg_summary = _('Deleted Desktop Profile "%(value)s"')
 
+    def pre_callback(self, ldap, dn, *keys, **options):
+        assert isinstance(dn, DN)
+        entries = self.obj._find_children(ldap, dn, ['cn'])
+        if not entries:
+            return dn
+        raise errors.DependentEntry(
+            key=keys[-1], label=self.obj.object_name,
+            dependent=entries[0].single_value['cn'])
+
 
 
 @register()
@@ -227,6 +791,57 @@ class deskprofile_mod(LDAPUpdate):
 
     msg_summary = _('Modified Desktop Profile "%(value)s"')
 
+    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+        assert isinstance(dn, DN)
+        if 'ipadeskprofileparent' in entry_attrs:
+            entry_attrs['ipadeskprofileparent'] = self.obj._normalize_parent(
+                ldap, dn, entry_attrs['ipadeskprofileparent'])
+
+        if 'ipadeskprofileparent' in entry_attrs or \
+                entry_attrs.get('ipadeskdata'):
+            try:
+                _entry_attrs = ldap.get_entry(
+                    dn, ['ipadeskdata', 'ipadesklayerdata',
+                         'ipadeskprofileparent'])
+            except errors.NotFound:
+                self.obj.handle_not_found(*keys)
+            if 'ipadeskprofileparent' in entry_attrs:
+                parent = entry_attrs['ipadeskprofileparent']
+            else:
+                parent = _entry_attrs.single_value.get('ipadeskprofileparent')
+            # The changes specified for the profile are kept when the parent
+            # is set or removed, a newly set parent applies to the data
+            # already stored
+            data = entry_attrs.get('ipadeskdata') or \
+                _entry_attrs.single_value.get('ipadesklayerdata') or \
+                _entry_attrs.single_value['ipadeskdata']
+            if parent:
+                self.obj._validate_layer(data)
+                entry_attrs['ipadesklayerdata'] = data
+                entry_attrs['ipadeskdata'] = self.obj._compose_data(
+                    ldap, data, DN(parent))
+            else:
+                entry_attrs['ipadesklayerdata'] = None
+                entry_attrs['ipadeskdata'] = data
+
+        return dn
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        assert isinstance(dn, DN)
+        if options.get('rename') is not None:
+            # Profiles extending a renamed profile have to follow it
+            old_dn = self.obj.get_dn(*keys)
+            for child in self.obj._find_children(
+                    ldap, old_dn, ['ipadeskprofileparent']):
+                child['ipadeskprofileparent'] = [dn]
+                ldap.update_entry(child)
+
+        # Every profile extending this one is composed again
+        if options.get('ipadeskdata') or 'ipadeskprofileparent' in options:
+            self.obj._update_children(ldap, dn)
+        self.obj._convert_data(ldap, entry_attrs, **options)
+        return dn
+
 
 
 @register()
@@ -237,12 +852,55 @@ class deskprofile_find(LDAPSearch):
         '%(count)d Desktop Profile matched', '%(count)d Desktop Profiles matched', 0
     )
 
+    takes_options = LDAPSearch.takes_options + (
+        Flag('delta',
+            cli_name='delta',
+            doc=_('Display only the changes specified for the profiles '
+                  'without the data of their parents'),
+        ),
+    )
+
+    def pre_callback(self, ldap, filter, attrs_list, base_dn, scope, *args, **options):
+        if options.get('ipadeskprofileparent'):
+            parent_filter = ldap.make_filter_from_attr(
+                'ipadeskprofileparent',
+                self.obj.get_dn(options['ipadeskprofileparent']))
+            filter = ldap.combine_filters(
+                (filter, parent_filter), rules=ldap.MATCH_ALL)
+        return (filter, base_dn, scope)
+
+    def args_options_2_entry(self, *args, **options):
+        # The parent is matched by its dn in pre_callback
+        options.pop('ipadeskprofileparent', None)
+        return super(deskprofile_find, self).args_options_2_entry(
+            *args, **options)
+
+    def post_callback(self, ldap, entries, truncated, *args, **options):
+        if options.get('pkey_only', False):
+            return truncated
+        for attrs in entries:
+            self.obj._convert_data(ldap, attrs, **options)
+        return truncated
+
 
 
 @register()
 class deskprofile_show(LDAPRetrieve):
     __doc__ = _('Display the properties of a Desktop Profile.')
 
+    takes_options = LDAPRetrieve.takes_options + (
+        Flag('delta',
+            cli_name='delta',
+            doc=_('Display only the changes specified for the profile '
+                  'without the data of its parents'),
+        ),
+    )
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        assert isinstance(dn, DN)
+        self.obj._convert_data(ldap, entry_attrs, **options)
+        return dn
+
 
 
 @register()
@@ -299,6 +957,26 @@ class deskprofilerule(LDAPObject):
             'ipapermright': {'delete'},
             'default_privileges': {'FleetCommander Desktop Profile Administrators'},
         },
+        'System: Read FleetCommander Desktop Profile Rule Container': {
+            'ipapermbindruletype': 'all',
+            'ipapermright': {'read', 'search', 'compare'},
+            'ipapermtargetfilter': {'(objectclass=nscontainer)'},
+            'ipapermdefaultattr': {
+                'cn', 'objectclass',
+            },
+        },
+        'System: Add FleetCommander Desktop Profile Rule Container': {
+            'ipapermbindruletype': 'permission',
+            'ipapermright': {'add'},
+            'ipapermtargetfilter': {'(objectclass=nscontainer)'},
+            'default_privileges': {'FleetCommander Desktop Profile Administrators'},
+        },
+        'System: Remove FleetCommander Desktop Profile Rule Container': {
+            'ipapermbindruletype': 'permission',
+            'ipapermright': {'delete'},
+            'ipapermtargetfilter': {'(objectclass=nscontainer)'},
+            'default_privileges': {'FleetCommander Desktop Profile Administrators'},
+        },
     }
 
     label = _('FleetCommander Desktop Profile Rule Map')
@@ -363,6 +1041,26 @@ class deskprofilerule(LDAPObject):
             label=_('Host Groups'),
             flags=['no_create', 'no_update', 'no_search'],
         ),
+        Int('memberuser_user_count?',
+            label=_('Number of users'),
+            flags=['no_create', 'no_update', 'no_search'],
+        ),
+        Int('memberuser_group_count?',
+            label=_('Number of user groups'),
+            flags=['no_create', 'no_update', 'no_search'],
+        ),
+        Int('memberhost_host_count?',
+            label=_('Number of hosts'),
+            flags=['no_create', 'no_update', 'no_search'],
+        ),
+        Int('memberhost_hostgroup_count?',
+            label=_('Number of host groups'),
+            flags=['no_create', 'no_update', 'no_search'],
+        ),
+        Str('container?',
+            label=_('Rule container'),
+            flags=['no_create', 'no_update', 'no_search'],
+        ),
     )
 
     # Inject constants into the api.env before it is locked down
@@ -439,6 +1137,372 @@ class deskprofilerule(LDAPObject):
             profile_attrs = ldap.get_entry(entry_attrs['ipadeskprofiletarget'][0], ['cn'])
             entry_attrs['ipadeskprofiletarget'] = profile_attrs['cn'][0]
 
+    def get_dn(self, *keys, **options):
+        """
+        Rules may be kept in rule containers below the top-level rule
+        container. Return the DN of an existing rule wherever it is kept
+        and the top-level DN of a rule which does not exist.
+        """
+        dn = super(deskprofilerule, self).get_dn(*keys, **options)
+        if not keys:
+            return dn
+        rule_dn = self._find_rule_dn(self.backend, keys[-1])
+        if rule_dn is not None:
+            return rule_dn
+        return dn
+
+    def _find_rule_dn(self, ldap, name):
+        """
+        Find a rule by name in the top-level container and in all rule
+        containers. Returns None if there is no such rule.
+        """
+        search_filter = ldap.combine_filters(
+            (ldap.make_filter_from_attr('objectclass', self.object_class,
+                                        rules=ldap.MATCH_ALL),
+             ldap.make_filter_from_attr(self.primary_key.name, name)),
+            rules=ldap.MATCH_ALL)
+        try:
+            entries, truncated = ldap.find_entries(
+                search_filter, [''], self._container_dn(),
+                scope=ldap.SCOPE_SUBTREE)
+        except errors.NotFound:
+            return None
+        if len(entries) > 1:
+            raise errors.SingleMatchExpected(found=len(entries))
+        return entries[0].dn
+
+    def _find_rules(self, ldap, search_filter, attrs_list, containers=None):
+        """
+        Search rules matching a filter. Without containers the whole rule
+        subtree is searched, otherwise only the top-level container and
+        the given rule containers.
+        """
+        search_filter = ldap.combine_filters(
+            (ldap.make_filter_from_attr('objectclass', self.object_class,
+                                        rules=ldap.MATCH_ALL),
+             search_filter),
+            rules=ldap.MATCH_ALL)
+        if containers is None:
+            bases = [(self._container_dn(), ldap.SCOPE_SUBTREE)]
+        else:
+            bases = [(self._container_dn(container), ldap.SCOPE_ONELEVEL)
+                     for container in [None] + list(containers)]
+
+        result = []
+        for base_dn, scope in bases:
+            try:
+                entries, truncated = ldap.find_entries(
+                    search_filter, attrs_list, base_dn,
+                    scope=scope, paged_search=True)
+            except errors.NotFound:
+                continue
+            result.extend(entries)
+        return result
+
+    def _container_dn(self, container=None):
+        """
+        Return the DN of a rule container or of the top-level container
+        """
+        base_dn = DN(self.container_dn, api.env.basedn)
+        if not container:
+            return base_dn
+        return DN(('cn', container), base_dn)
+
+    def _ensure_container(self, ldap, container):
+        """
+        Return the DN of a rule container, creating it if it does not
+        exist yet.
+        """
+        dn = self._container_dn(container)
+        if dn == self._container_dn():
+            return dn
+
+        entry = ldap.make_entry(
+            dn, objectclass=['top', 'nsContainer'], cn=[container])
+        try:
+            ldap.add_entry(entry)
+        except errors.DuplicateEntry:
+            # The CoS definition lives next to the rule containers
+            try:
+                entry = ldap.get_entry(dn, ['objectclass'])
+                objectclasses = [oc.lower() for oc in entry['objectclass']]
+            except errors.NotFound:
+                objectclasses = []
+            if 'nscontainer' not in objectclasses:
+                raise errors.ValidationError(
+                    name='container',
+                    error=_('%(container)s is not a rule container')
+                    % dict(container=container))
+        return dn
+
+    def _move_rule(self, ldap, dn, new_dn):
+        """
+        Move a rule to another rule container. The rule is re-created in
+        the new container, which only needs the rights to add and remove
+        rules, and gets a new unique ID. The old rule is removed once the
+        new one exists.
+        """
+        entry_attrs = ldap.get_entry(dn, ['*'])
+        # ipaDeskData is supplied by CoS and not stored in the rule, the
+        # unique ID can only be generated by the server
+        attrs = dict((attr, entry_attrs[attr]) for attr in entry_attrs
+                     if attr.lower() not in ('ipadeskdata', 'ipauniqueid'))
+        attrs['ipauniqueid'] = ['autogenerate']
+        ldap.add_entry(ldap.make_entry(new_dn, attrs))
+        try:
+            ldap.delete_entry(dn)
+        except errors.ExecutionError:
+            ldap.delete_entry(new_dn)
+            raise
+        return new_dn
+
+    def _get_container(self, dn):
+        """
+        Return the name of the rule container a rule is kept in or None
+        for the top-level container.
+        """
+        parent_dn = DN(*dn[1:])
+        if parent_dn == self._container_dn():
+            return None
+        return parent_dn[0].value
+
+    def _convert_container(self, entry_attrs):
+        """
+        Add the name of the rule container to a rule kept in one
+        """
+        container = self._get_container(entry_attrs.dn)
+        if container is not None:
+            entry_attrs['container'] = [container]
+
+    def _classify_members(self, entry_attrs, attrs=None):
+        """
+        Yield the member attribute, the member type and the DN of every
+        memberUser and memberHost value of a rule. The type is found from
+        the container of the member, member entries are not looked up.
+        """
+        for attr, obj_names in self.attribute_members.items():
+            if attrs is not None and attr not in attrs:
+                continue
+            containers = [
+                (obj_name, DN(self.api.Object[obj_name].container_dn,
+                              api.env.basedn))
+                for obj_name in obj_names]
+            for value in entry_attrs.get(attr, []):
+                member_dn = DN(value)
+                for obj_name, container_dn in containers:
+                    if member_dn.endswith(container_dn):
+                        yield attr, obj_name, member_dn
+                        break
+
+    def _split_members(self, entry_attrs):
+        """
+        Split memberUser and memberHost values of a rule into names per
+        member type without looking up the member entries.
+        """
+        members = {}
+        for attr, obj_name, member_dn in self._classify_members(entry_attrs):
+            ldap_obj = self.api.Object[obj_name]
+            members.setdefault('%s_%s' % (attr, obj_name), []).append(
+                ldap_obj.get_primary_key_from_dn(member_dn))
+        return members
+
+    def _summarize_members(self, entry_attrs, **options):
+        """
+        Replace the members of a rule by the number of members per type
+        """
+        if not options.get('summary', False):
+            return
+
+        counts = dict((attr, 0) for attr in RULE_MEMBER_ATTRIBUTES)
+        for attr, obj_name, member_dn in self._classify_members(entry_attrs):
+            counts['%s_%s' % (attr, obj_name)] += 1
+        for attr, count in counts.items():
+            entry_attrs['%s_count' % attr] = [count]
+        for attr in self.attribute_members:
+            entry_attrs.pop(attr, None)
+
+    def _search_chunked(self, ldap, obj_name, attr, values, attrs_list):
+        """
+        Search entries of IPA objects whose attribute matches any of the
+        values with one search per chunk of values.
+        """
+        ldap_obj = self.api.Object[obj_name]
+        base_dn = DN(ldap_obj.container_dn, api.env.basedn)
+        attrs_list = [ldap_obj.primary_key.name] + list(attrs_list)
+        values = list(set(values))
+        result = []
+        for i in range(0, len(values), SEARCH_CHUNK_SIZE):
+            search_filter = ldap.make_filter_from_attr(
+                attr, values[i:i + SEARCH_CHUNK_SIZE], rules=ldap.MATCH_ANY)
+            try:
+                entries, truncated = ldap.find_entries(
+                    search_filter, attrs_list, base_dn,
+                    scope=ldap.SCOPE_ONELEVEL, paged_search=True)
+            except errors.NotFound:
+                continue
+            result.extend(entries)
+        return result
+
+    def _find_by_names(self, ldap, obj_name, names, attrs_list):
+        """
+        Retrieve entries of IPA objects by name. Returns a dictionary
+        keyed by the lowercased name.
+
+        Like host.get_dn, hosts which are not found by their fully
+        qualified name are looked up by their short name, which has to
+        match a single host.
+        """
+        pkey = self.api.Object[obj_name].primary_key.name
+        entries = self._search_chunked(ldap, obj_name, pkey, names,
+                                       attrs_list)
+        result = dict((entry.single_value[pkey].lower(), entry)
+                      for entry in entries)
+        if obj_name != 'host':
+            return result
+
+        missing = set(name.lower() for name in names) - set(result)
+        short_names = {}
+        for entry in self._search_chunked(
+                ldap, obj_name, 'serverhostname', missing,
+                list(attrs_list) + ['serverhostname']):
+            short_names.setdefault(
+                entry.single_value['serverhostname'].lower(), []).append(entry)
+        for name, found in short_names.items():
+            if name in missing and len(found) == 1:
+                result[name] = found[0]
+        return result
+
+    def _map_names(self, ldap, obj_name, names):
+        """
+        Resolve names of IPA objects to their DNs. Returns a dictionary
+        keyed by the lowercased name.
+        """
+        entries = self._find_by_names(ldap, obj_name, names, [])
+        return dict((name, entry.dn) for name, entry in entries.items())
+
+    def _matches(self, entry_attrs, category, member_attr, dns):
+        """
+        Check whether a rule applies to any of the given DNs through its
+        category or its members.
+        """
+        if is_all(entry_attrs, category):
+            return True
+        return any(DN(value) in dns
+                   for value in entry_attrs.get(member_attr, []))
+
+    def _member_dns(self, entry_attrs):
+        """
+        Return the DN of a user or a host together with the DNs of all
+        groups it is a direct or indirect member of.
+        """
+        return set([entry_attrs.dn] +
+                   [DN(value) for value in entry_attrs.get('memberof', [])])
+
+    def _resolve_host_rules(self, ldap, host_dns, containers=None):
+        """
+        Find enabled rules which apply to a host. Returns a list of
+        (rule, members) pairs ordered by priority where members is the
+        entry defining the users of the rule: either the rule itself or
+        the HBAC rule it refers to. With containers only the top-level
+        container and the given rule containers are searched.
+
+        Member DNs are matched with one search per chunk of DNs, rules
+        for all hosts and rules referring to HBAC rules are found by the
+        first search.
+        """
+        values = list(host_dns)
+        entries = OrderedDict()
+        for i in range(0, max(len(values), 1), SEARCH_CHUNK_SIZE):
+            terms = []
+            if i == 0:
+                terms.extend([
+                    ldap.make_filter_from_attr('hostcategory', 'all'),
+                    '(seealso=*)'])
+            chunk = values[i:i + SEARCH_CHUNK_SIZE]
+            if chunk:
+                terms.append(ldap.make_filter_from_attr(
+                    'memberhost', chunk, rules=ldap.MATCH_ANY))
+            search_filter = ldap.combine_filters(
+                (ldap.make_filter_from_attr('ipaenabledflag', 'TRUE'),
+                 ldap.combine_filters(terms, rules=ldap.MATCH_ANY)),
+                rules=ldap.MATCH_ALL)
+            for entry in self._find_rules(ldap, search_filter,
+                                          RESOLVE_ATTRIBUTES, containers):
+                entries[entry.dn] = entry
+
+        hbac_rules = {}
+        rules = []
+        for entry in entries.values():
+            members = entry
+            if 'seealso' in entry:
+                hbac_dn = DN(entry.single_value['seealso'])
+                if hbac_dn not in hbac_rules:
+                    try:
+                        hbac_rules[hbac_dn] = ldap.get_entry(
+                            hbac_dn, RESOLVE_ATTRIBUTES)
+                    except errors.NotFound:
+                        hbac_rules[hbac_dn] = None
+                members = hbac_rules[hbac_dn]
+                if members is None:
+                    continue
+            if self._matches(members, 'hostcategory', 'memberhost', host_dns):
+                rules.append((entry, members))
+
+        rules.sort(key=lambda rule: (
+            int(rule[0].single_value['ipadeskprofilepriority']),
+            rule[0].single_value['cn'].lower()))
+        return rules
+
+    def _resolve_profiles(self, ldap, rules):
+        """
+        Read the data of every profile referenced by the rules once.
+
+        The data is read through the rule rather than from the profile
+        entry: the CoS-supplied ipaDeskData of a rule is readable by the
+        members of the rule while the profile itself is not.
+        """
+        profiles = {}
+        for rule in rules:
+            name = DN(rule.single_value['ipadeskprofiletarget'])[0].value
+            if name in profiles:
+                continue
+            entry = ldap.get_entry(rule.dn, ['ipadeskdata'])
+            profiles[name] = entry.single_value.get('ipadeskdata')
+        return profiles
+
+    def _resolve_users(self, ldap, rules):
+        """
+        Retrieve all users the rules may apply to: users referenced
+        directly and members of referenced groups. A rule for all users
+        brings in every user.
+        """
+        user_container = DN(self.api.Object['user'].container_dn,
+                            api.env.basedn)
+        group_container = DN(self.api.Object['group'].container_dn,
+                             api.env.basedn)
+        attrs_list = ['memberof']
+
+        names = set()
+        group_dns = set()
+        for rule, members in rules:
+            if is_all(members, 'usercategory'):
+                return self._search_chunked(
+                    ldap, 'user', 'objectclass', ['posixaccount'], attrs_list)
+            for value in members.get('memberuser', []):
+                member_dn = DN(value)
+                if member_dn.endswith(user_container):
+                    names.add(
+                        self.api.Object['user'].get_primary_key_from_dn(
+                            member_dn))
+                elif member_dn.endswith(group_container):
+                    group_dns.add(member_dn)
+
+        users = self._find_by_names(ldap, 'user', names, attrs_list)
+        for entry in self._search_chunked(ldap, 'user', 'memberof',
+                                          group_dns, attrs_list):
+            users[entry.single_value['uid'].lower()] = entry
+        return list(users.values())
+
 
 @register()
 class deskprofilerule_add(LDAPCreate):
@@ -446,6 +1510,15 @@ class deskprofilerule_add(LDAPCreate):
 
     msg_summary = _('Added Desktop Profile Rule Map "%(value)s"')
 
+    takes_options = LDAPCreate.takes_options + (
+        Str('container?',
+            cli_name='container',
+            label=_('Rule container'),
+            doc=_('Rule container to keep the rule in, created if it does '
+                  'not exist (default: the top-level container)'),
+        ),
+    )
+
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         assert isinstance(dn, DN)
         # rules are enabled by default
@@ -469,12 +1542,20 @@ class deskprofilerule_add(LDAPCreate):
         entry_attrs['ipadeskprofiletarget'] = \
             self.obj._normalize_profile(entry_attrs['ipadeskprofiletarget'])
 
+        if options.get('container'):
+            # Rule names are unique across all rule containers
+            if self.obj._find_rule_dn(ldap, keys[-1]) is not None:
+                self.obj.handle_duplicate_entry(*keys)
+            dn = DN(dn[0], self.obj._ensure_container(ldap,
+                                                      options['container']))
+
         return dn
 
     def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
         assert isinstance(dn, DN)
         self.obj._convert_seealso(ldap, entry_attrs, **options)
         self.obj._convert_profile(ldap, entry_attrs, **options)
+        self.obj._convert_container(entry_attrs)
 
         return dn
 
@@ -494,6 +1575,15 @@ class deskprofilerule_mod(LDAPUpdate):
 
     msg_summary = _('Modified Desktop Profile Rule Map "%(value)s"')
 
+    takes_options = LDAPUpdate.takes_options + (
+        Str('container?',
+            cli_name='container',
+            label=_('Rule container'),
+            doc=_('Rule container to move the rule to, created if it does '
+                  'not exist'),
+        ),
+    )
+
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         assert isinstance(dn, DN)
         try:
@@ -533,15 +1623,46 @@ class deskprofilerule_mod(LDAPUpdate):
         if 'seealso' in entry_attrs:
             entry_attrs['seealso'] = self.obj._normalize_seealso(entry_attrs['seealso'])
 
-        entry_attrs['ipadeskprofiletarget'] = \
-            self.obj._normalize_profile(entry_attrs['ipadeskprofiletarget'])
+        if 'ipadeskprofiletarget' in entry_attrs:
+            entry_attrs['ipadeskprofiletarget'] = \
+                self.obj._normalize_profile(entry_attrs['ipadeskprofiletarget'])
+
+        # Rule names are unique across all rule containers
+        if options.get('rename') and \
+                self.obj._find_rule_dn(ldap, options['rename']) is not None:
+            self.obj.handle_duplicate_entry(options['rename'])
+
+        if options.get('container'):
+            new_dn = DN(dn[0], self.obj._ensure_container(
+                ldap, options['container']))
+            if new_dn != dn:
+                dn = self.obj._move_rule(ldap, dn, new_dn)
+
+        # The rule is renamed in the container it is kept in rather than
+        # at the DN get_dn() gives for a rule which does not exist yet
+        if options.get('rename'):
+            new_dn = DN((self.obj.primary_key.name, options['rename']),
+                        *dn[1:])
+            if new_dn != dn:
+                ldap.move_entry(dn, new_dn)
+                dn = new_dn
 
         return dn
 
+    def exc_callback(self, keys, options, exc, call_func, *call_args,
+                     **call_kwargs):
+        # Moving a rule to another container is a modification on its own
+        if call_func.__name__ == 'update_entry' and \
+                isinstance(exc, errors.EmptyModlist) and \
+                options.get('container'):
+            return
+        raise exc
+
     def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
         assert isinstance(dn, DN)
         self.obj._convert_seealso(ldap, entry_attrs, **options)
         self.obj._convert_profile(ldap, entry_attrs, **options)
+        self.obj._convert_container(entry_attrs)
         return dn
 
 
@@ -554,6 +1675,20 @@ class deskprofilerule_find(LDAPSearch):
         '%(count)d Desktop Profile Rule Map matched', '%(count)d Desktop Profile Rule Maps matched', 0
     )
 
+    takes_options = LDAPSearch.takes_options + (
+        Flag('summary',
+            cli_name='summary',
+            doc=_('Display the number of members per type instead of '
+                  'the members'),
+        ),
+        Str('container?',
+            cli_name='container',
+            label=_('Rule container'),
+            doc=_('Search only the rules kept in this rule container '
+                  '(default: all rules)'),
+        ),
+    )
+
     def execute(self, *args, **options):
         # If searching on hbacrule we need to find the uuid to search on
         if options.get('seealso'):
@@ -569,12 +1704,22 @@ class deskprofilerule_find(LDAPSearch):
 
         return super(deskprofilerule_find, self).execute(*args, **options)
 
+    def pre_callback(self, ldap, filter, attrs_list, base_dn, scope,
+                     *args, **options):
+        assert isinstance(base_dn, DN)
+        if options.get('container'):
+            return (filter, self.obj._container_dn(options['container']),
+                    ldap.SCOPE_ONELEVEL)
+        return (filter, base_dn, ldap.SCOPE_SUBTREE)
+
     def post_callback(self, ldap, entries, truncated, *args, **options):
         if options.get('pkey_only', False):
             return truncated
         for attrs in entries:
             self.obj._convert_seealso(ldap, attrs, **options)
             self.obj._convert_profile(ldap, attrs, **options)
+            self.obj._convert_container(attrs)
+            self.obj._summarize_members(attrs, **options)
         return truncated
 
 
@@ -583,14 +1728,106 @@ class deskprofilerule_find(LDAPSearch):
 class deskprofilerule_show(LDAPRetrieve):
     __doc__ = _('Display the properties of a Desktop Profile Rule Map.')
 
+    takes_options = LDAPRetrieve.takes_options + (
+        Flag('summary',
+            cli_name='summary',
+            doc=_('Display the number of members per type instead of '
+                  'the members'),
+        ),
+    )
+
     def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
         assert isinstance(dn, DN)
         self.obj._convert_seealso(ldap, entry_attrs, **options)
         self.obj._convert_profile(ldap, entry_attrs, **options)
+        self.obj._convert_container(entry_attrs)
+        self.obj._summarize_members(entry_attrs, **options)
         return dn
 
 
 
+@register()
+class deskprofilerule_member_find(LDAPQuery):
+    __doc__ = _('Search for members of a Desktop Profile Rule Map.')
+
+    msg_summary = ngettext(
+        '%(count)d member matched', '%(count)d members matched', 0
+    )
+
+    takes_options = LDAPQuery.takes_options + (
+        StrEnum('type?',
+            cli_name='type',
+            label=_('Member type'),
+            doc=_('Type of the members to search for'),
+            values=(u'user', u'group', u'host', u'hostgroup'),
+        ),
+        Str('criteria?',
+            cli_name='criteria',
+            label=_('Criteria'),
+            doc=_('A string searched in member names'),
+        ),
+        Int('offset?',
+            cli_name='offset',
+            label=_('Offset'),
+            doc=_('Number of matching members to skip'),
+            minvalue=0,
+            default=0,
+            autofill=True,
+        ),
+        Int('limit?',
+            cli_name='limit',
+            label=_('Limit'),
+            doc=_('Maximum number of members returned'),
+            minvalue=1,
+            maxvalue=10000,
+            default=100,
+            autofill=True,
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', (list, tuple),
+                      _('Members ordered by type and name')),
+        output.Output('count', int, _('Number of matching members')),
+        output.Output('truncated', bool,
+                      _('True if more matching members follow')),
+    )
+
+    def execute(self, *keys, **options):
+        ldap = self.obj.backend
+        member_type = options.get('type')
+        attrs = [attr for attr, obj_names in self.obj.attribute_members.items()
+                 if member_type is None or member_type in obj_names]
+
+        dn = self.obj.get_dn(*keys, **options)
+        try:
+            entry_attrs = ldap.get_entry(dn, attrs)
+        except errors.NotFound:
+            self.obj.handle_not_found(*keys)
+
+        criteria = (options.get('criteria') or u'').lower()
+        members = []
+        for attr, obj_name, member_dn in self.obj._classify_members(
+                entry_attrs, attrs):
+            if member_type is not None and obj_name != member_type:
+                continue
+            name = self.api.Object[obj_name].get_primary_key_from_dn(member_dn)
+            if criteria in name.lower():
+                members.append((obj_name, name))
+        members.sort(key=lambda member: (member[0], member[1].lower()))
+
+        offset = options.get('offset') or 0
+        limit = options.get('limit') or 100
+        page = members[offset:offset + limit]
+        return dict(
+            result=[dict(type=obj_name, name=name) for obj_name, name in page],
+            count=len(members),
+            truncated=offset + limit < len(members),
+        )
+
+
+
 @register()
 class deskprofilerule_enable(LDAPQuery):
     __doc__ = _('Enable a Desktop Profile Rule Map.')
@@ -651,8 +1888,112 @@ class deskprofilerule_disable(LDAPQuery):
 
 
 
+class BatchedAddMember(LDAPAddMember):
+    """
+    Add members to a rule with one search and one modification per chunk
+    of members instead of a lookup and a modification per member.
+    """
+    def execute(self, *keys, **options):
+        ldap = self.obj.backend
+        dn = self.obj.get_dn(*keys, **options)
+        member_attr = self.member_attributes[0]
+
+        member_dns = {member_attr: {}}
+        failed = {member_attr: {}}
+        names = {}
+        for obj_name in self.obj.attribute_members[member_attr]:
+            requested = options.get(obj_name) or []
+            found = self.obj._map_names(ldap, obj_name, requested)
+            member_dns[member_attr][obj_name] = []
+            failed[member_attr][obj_name] = []
+            for name in requested:
+                member_dn = found.get(name.lower())
+                if member_dn is None:
+                    failed[member_attr][obj_name].append(
+                        (name, unicode(_('no such entry'))))
+                elif member_dn not in names:
+                    member_dns[member_attr][obj_name].append(member_dn)
+                    names[member_dn] = (obj_name, name)
+
+        for callback in self.get_callbacks('pre'):
+            dn = callback(self, ldap, dn, member_dns, failed, *keys, **options)
+        assert isinstance(dn, DN)
+
+        values = [member_dn
+                  for obj_name in self.obj.attribute_members[member_attr]
+                  for member_dn in member_dns[member_attr][obj_name]]
+        present = self._add_values(ldap, dn, member_attr, values,
+                                   keys, options)
+        for member_dn in present:
+            obj_name, name = names[member_dn]
+            failed[member_attr][obj_name].append(
+                (name, unicode(errors.AlreadyGroupMember())))
+        completed = len(values) - len(present)
+
+        if options.get('all', False):
+            attrs_list = ['*'] + self.obj.default_attributes
+        else:
+            attrs_list = list(self.obj.default_attributes)
+        if options.get('no_members', False):
+            attrs_list = [attr for attr in attrs_list
+                          if attr not in self.obj.attribute_members]
+        try:
+            entry_attrs = self._exc_wrapper(keys, options, ldap.get_entry)(
+                dn, attrs_list)
+        except errors.NotFound:
+            self.obj.handle_not_found(*keys)
+
+        for callback in self.get_callbacks('post'):
+            (completed, dn) = callback(
+                self, ldap, completed, failed, dn, entry_attrs,
+                *keys, **options)
+
+        self.obj.convert_attribute_members(entry_attrs, *keys, **options)
+        return dict(
+            completed=completed,
+            failed=failed,
+            result=entry_to_dict(entry_attrs, **options),
+        )
+
+    def _add_values(self, ldap, dn, attr, values, keys, options):
+        """
+        Add values to a member attribute with one modification per chunk
+        of values without reading the current members. Returns the values
+        which were present already.
+        """
+        update_entry = self._exc_wrapper(keys, options, ldap.update_entry)
+
+        def add(chunk):
+            # The modification is generated against a value which is in
+            # both the old and the new list, the DN of the rule itself,
+            # so it only adds the chunk
+            entry = ldap.make_entry(dn, {attr: [dn]})
+            entry.reset_modlist()
+            entry[attr] = [dn] + chunk
+            try:
+                update_entry(entry)
+            except errors.NotFound:
+                self.obj.handle_not_found(*keys)
+
+        present = []
+        for i in range(0, len(values), MODIFY_CHUNK_SIZE):
+            chunk = values[i:i + MODIFY_CHUNK_SIZE]
+            try:
+                add(chunk)
+            except errors.DuplicateEntry:
+                # Some of the members are present already, add the chunk
+                # one value at a time to find out which
+                for value in chunk:
+                    try:
+                        add([value])
+                    except errors.DuplicateEntry:
+                        present.append(value)
+        return present
+
+
+
 @register()
-class deskprofilerule_add_user(LDAPAddMember):
+class deskprofilerule_add_user(BatchedAddMember):
     __doc__ = _('Add users and groups to a Desktop Profile Rule Map.')
 
     member_attributes = ['memberuser']
@@ -661,7 +2002,7 @@ class deskprofilerule_add_user(LDAPAddMember):
     def pre_callback(self, ldap, dn, found, not_found, *keys, **options):
         assert isinstance(dn, DN)
         try:
-            entry_attrs = ldap.get_entry(dn, self.obj.default_attributes)
+            entry_attrs = ldap.get_entry(dn, ['usercategory', 'seealso'])
             dn = entry_attrs.dn
         except errors.NotFound:
             self.obj.handle_not_found(*keys)
@@ -685,7 +2026,7 @@ class deskprofilerule_remove_user(LDAPRemoveMember):
 
 
 @register()
-class deskprofilerule_add_host(LDAPAddMember):
+class deskprofilerule_add_host(BatchedAddMember):
     __doc__ = _('Add target hosts and hostgroups to a Desktop Profile Rule Map.')
 
     member_attributes = ['memberhost']
@@ -694,7 +2035,7 @@ class deskprofilerule_add_host(LDAPAddMember):
     def pre_callback(self, ldap, dn, found, not_found, *keys, **options):
         assert isinstance(dn, DN)
         try:
-            entry_attrs = ldap.get_entry(dn, self.obj.default_attributes)
+            entry_attrs = ldap.get_entry(dn, ['hostcategory', 'seealso'])
             dn = entry_attrs.dn
         except errors.NotFound:
             self.obj.handle_not_found(*keys)
@@ -775,3 +2116,729 @@ class deskprofileconfig_mod(LDAPUpdate):
 class deskprofileconfig_show(LDAPRetrieve):
     __doc__ = _('Show Desktop Profile configuration options.')
 
+
+@register()
+class deskprofile_export_internal(Command):
+    __doc__ = _('Export Desktop Profiles, Rule Maps and configuration.')
+
+    NO_CLI = True
+
+    takes_options = (
+        StrEnum('type',
+            values=(u'config', u'profile', u'rule'),
+            doc=_('Type of the entries to export'),
+        ),
+        Str('names*',
+            doc=_('Names of the entries to export'),
+        ),
+    )
+
+    has_output = (
+        output.Output('result', (list, tuple),
+                      _('Exported entries')),
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+
+        if options['type'] == u'config':
+            config_obj = self.api.Object['deskprofileconfig']
+            entry = ldap.get_entry(config_obj.get_dn(),
+                                   ['ipadeskprofilepriority'])
+            return dict(result=[dict(
+                type=u'config',
+                ipadeskprofilepriority=int(
+                    entry.single_value['ipadeskprofilepriority']),
+            )])
+
+        names = options.get('names') or []
+        if not names:
+            return dict(result=[])
+
+        if options['type'] == u'rule':
+            rule_obj = self.api.Object['deskprofilerule']
+            entries = rule_obj._find_rules(
+                ldap, ldap.make_filter_from_attr('cn', names,
+                                                 rules=ldap.MATCH_ANY),
+                ['*'])
+            return dict(result=[self._export_rule(entry)
+                                for entry in entries])
+
+        ldap_obj = self.api.Object['deskprofile']
+        search_filter = ldap.combine_filters(
+            (ldap.make_filter_from_attr('objectclass', ldap_obj.object_class,
+                                        rules=ldap.MATCH_ALL),
+             ldap.make_filter_from_attr('cn', names, rules=ldap.MATCH_ANY)),
+            rules=ldap.MATCH_ALL)
+        try:
+            entries, truncated = ldap.find_entries(
+                search_filter, ['*'],
+                DN(ldap_obj.container_dn, api.env.basedn),
+                scope=ldap.SCOPE_ONELEVEL, paged_search=True)
+        except errors.NotFound:
+            entries = []
+        return dict(result=[self._export_profile(entry) for entry in entries])
+
+    def _export_profile(self, entry):
+        # Layered profiles are exported with their own changes only
+        record = dict(
+            type=u'profile',
+            cn=entry.single_value['cn'],
+            ipadeskdata=entry.single_value.get(
+                'ipadesklayerdata', entry.single_value['ipadeskdata']),
+        )
+        if 'description' in entry:
+            record['description'] = entry.single_value['description']
+        if 'ipadeskprofileparent' in entry:
+            record['ipadeskprofileparent'] = DN(
+                entry.single_value['ipadeskprofileparent'])[0].value
+        return record
+
+    def _export_rule(self, entry):
+        # References are exported by name so that the archive does not
+        # depend on the base DN of the realm it was taken from
+        enabled = entry.single_value.get('ipaenabledflag', u'TRUE')
+        record = dict(
+            type=u'rule',
+            cn=entry.single_value['cn'],
+            ipadeskprofiletarget=DN(
+                entry.single_value['ipadeskprofiletarget'])[0].value,
+            ipadeskprofilepriority=int(
+                entry.single_value['ipadeskprofilepriority']),
+            ipaenabledflag=unicode(enabled).upper() == u'TRUE',
+        )
+        for attr in ('description', 'usercategory', 'hostcategory'):
+            if attr in entry:
+                record[attr] = entry.single_value[attr]
+        if 'seealso' in entry:
+            record['seealso'] = DN(entry.single_value['seealso'])[0].value
+        rule_obj = self.api.Object['deskprofilerule']
+        container = rule_obj._get_container(entry.dn)
+        if container is not None:
+            record['container'] = container
+        record.update(rule_obj._split_members(entry))
+        return record
+
+
+@register()
+class deskprofile_import_internal(Command):
+    __doc__ = _('Import Desktop Profiles, Rule Maps and configuration.')
+
+    NO_CLI = True
+
+    takes_options = (
+        Dict('records+',
+            doc=_('Entries to import'),
+        ),
+    )
+
+    has_output = (
+        output.Output('result', dict,
+                      _('Number of imported entries per type')),
+        output.Output('failed', (list, tuple),
+                      _('Entries that could not be imported')),
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        counts = dict(config=0, profile=0, rule=0)
+        failed = []
+
+        records = dict(config=[], profile=[], rule=[])
+        for record in options['records']:
+            if record.get('type') not in records:
+                failed.append(dict(
+                    type=record.get('type'), cn=record.get('cn'),
+                    error=unicode(_('unknown entry type'))))
+                continue
+            records[record['type']].append(record)
+
+        for record in records['config']:
+            if self._import_config(ldap, record, failed):
+                counts['config'] += 1
+
+        # Profiles go first so that rules of the same batch can refer to them
+        imported = []
+        for record in records['profile']:
+            if self._import_profile(ldap, record, failed):
+                counts['profile'] += 1
+                imported.append(record)
+
+        # Parents may come after the profiles extending them, in this batch
+        # or in a later one. The data is composed once all profiles of the
+        # batch exist, and profiles imported earlier are composed again
+        # when their parent arrives.
+        names = set(record['cn'].lower() for record in imported)
+        for record in imported:
+            parent = record.get('ipadeskprofileparent')
+            if parent and parent.lower() in names:
+                continue
+            self._compose_profile(ldap, record, failed)
+
+        # Invalid rules are left out before references are looked up
+        rules = []
+        for record in records['rule']:
+            try:
+                self._validate_record(
+                    'deskprofilerule', record,
+                    ['cn', 'ipadeskprofiletarget', 'ipadeskprofilepriority',
+                     'seealso', 'usercategory', 'hostcategory',
+                     'description'])
+                self._check_rule(record)
+            except errors.PublicError as e:
+                failed.append(dict(type=u'rule', cn=record.get('cn'),
+                                   error=unicode(e)))
+                continue
+            rules.append(record)
+        records['rule'] = rules
+
+        if records['rule']:
+            refs = self._map_references(ldap, records['rule'])
+            rule_obj = self.api.Object['deskprofilerule']
+            containers = set(record['container'] for record in records['rule']
+                             if record.get('container'))
+            refs['container'] = dict(
+                (container, rule_obj._ensure_container(ldap, container))
+                for container in containers)
+            refs['rule'] = self._find_existing_rules(ldap, records['rule'])
+            for record in records['rule']:
+                if self._import_rule(ldap, record, refs, failed):
+                    counts['rule'] += 1
+
+        return dict(result=counts, failed=failed)
+
+    def _validate_record(self, obj_name, record, attrs):
+        """
+        Validate the values of a record with the parameters of the object
+        the record is imported as.
+        """
+        params = self.api.Object[obj_name].params
+        for attr in attrs:
+            if record.get(attr) is not None:
+                params[attr].validate(params[attr].convert(record[attr]))
+            elif params[attr].required:
+                raise errors.RequirementError(name=attr)
+
+    def _check_rule(self, record):
+        """
+        Apply the checks of deskprofilerule-add and deskprofilerule-mod on
+        categories, members and HBAC rules to a rule record.
+        """
+        has_members = lambda member_attr: any(
+            record.get(attr) for attr in RULE_MEMBER_ATTRIBUTES
+            if attr.startswith(member_attr + '_'))
+
+        if record.get('seealso') and (
+                record.get('usercategory') or record.get('hostcategory') or
+                has_members('memberuser') or has_members('memberhost')):
+            raise errors.MutuallyExclusiveError(reason=notboth_err)
+        if record.get('usercategory') == u'all' and has_members('memberuser'):
+            raise errors.MutuallyExclusiveError(reason=_(
+                "user category cannot be set to 'all' while there are "
+                "allowed users"))
+        if record.get('hostcategory') == u'all' and has_members('memberhost'):
+            raise errors.MutuallyExclusiveError(reason=_(
+                "host category cannot be set to 'all' while there are "
+                "allowed hosts"))
+
+    def _import_config(self, ldap, record, failed):
+        config_obj = self.api.Object['deskprofileconfig']
+        try:
+            self._validate_record('deskprofileconfig', record,
+                                  ['ipadeskprofilepriority'])
+        except errors.PublicError as e:
+            failed.append(dict(type=u'config', cn=None, error=unicode(e)))
+            return False
+        try:
+            entry = ldap.get_entry(config_obj.get_dn(),
+                                   ['ipadeskprofilepriority'])
+            entry['ipadeskprofilepriority'] = [
+                record['ipadeskprofilepriority']]
+            ldap.update_entry(entry)
+        except errors.EmptyModlist:
+            pass
+        except errors.ExecutionError as e:
+            failed.append(dict(type=u'config', cn=None, error=unicode(e)))
+            return False
+        return True
+
+    def _import_profile(self, ldap, record, failed):
+        profile_obj = self.api.Object['deskprofile']
+        try:
+            self._validate_record(
+                'deskprofile', record,
+                ['cn', 'description', 'ipadeskdata', 'ipadeskprofileparent'])
+            if record.get('ipadeskprofileparent'):
+                profile_obj._validate_layer(record['ipadeskdata'])
+        except errors.PublicError as e:
+            failed.append(dict(type=u'profile', cn=record.get('cn'),
+                               error=unicode(e)))
+            return False
+
+        entry = ldap.make_entry(
+            profile_obj.get_dn(record['cn']),
+            objectclass=list(profile_obj.object_class),
+            cn=[record['cn']],
+            ipauniqueid=['autogenerate'],
+            ipadeskdata=[record['ipadeskdata']],
+        )
+        if record.get('description'):
+            entry['description'] = [record['description']]
+        # The parent may come later in the archive, its existence is not
+        # checked. The data is composed once the parent exists.
+        if record.get('ipadeskprofileparent'):
+            entry['ipadeskprofileparent'] = [
+                profile_obj.get_dn(record['ipadeskprofileparent'])]
+            entry['ipadesklayerdata'] = [record['ipadeskdata']]
+        try:
+            ldap.add_entry(entry)
+        except errors.ExecutionError as e:
+            failed.append(dict(type=u'profile', cn=record['cn'],
+                               error=unicode(e)))
+            return False
+        return True
+
+    def _compose_profile(self, ldap, record, failed):
+        """
+        Compose the data of an imported profile if its parent exists and
+        the data of all profiles extending it.
+        """
+        profile_obj = self.api.Object['deskprofile']
+        dn = profile_obj.get_dn(record['cn'])
+        try:
+            if record.get('ipadeskprofileparent'):
+                entry = ldap.get_entry(
+                    dn, ['ipadeskdata', 'ipadesklayerdata',
+                         'ipadeskprofileparent'])
+                try:
+                    profile_obj._store_composed(ldap, entry)
+                except errors.NotFound:
+                    # The parent comes later and composes this profile
+                    return
+            profile_obj._update_children(ldap, dn)
+        except errors.ExecutionError as e:
+            failed.append(dict(type=u'profile', cn=record['cn'],
+                               error=unicode(e)))
+
+    def _find_existing_rules(self, ldap, rules):
+        """
+        Find the lowercased names of rules of a batch which exist in any
+        rule container already.
+        """
+        rule_obj = self.api.Object['deskprofilerule']
+        names = list(set(record['cn'] for record in rules))
+        existing = set()
+        for i in range(0, len(names), SEARCH_CHUNK_SIZE):
+            for entry in rule_obj._find_rules(
+                    ldap, ldap.make_filter_from_attr(
+                        'cn', names[i:i + SEARCH_CHUNK_SIZE],
+                        rules=ldap.MATCH_ANY),
+                    ['cn']):
+                existing.add(entry.single_value['cn'].lower())
+        return existing
+
+    def _map_references(self, ldap, rules):
+        """
+        Build a map of all profiles, HBAC rules and members referenced by
+        a batch of rules with one search per referenced object type.
+        """
+        rule_obj = self.api.Object['deskprofilerule']
+        names = dict(deskprofile=set(), hbacrule=set())
+        for record in rules:
+            names['deskprofile'].add(record['ipadeskprofiletarget'])
+            if record.get('seealso'):
+                names['hbacrule'].add(record['seealso'])
+            for attr in RULE_MEMBER_ATTRIBUTES:
+                obj_name = attr.split('_', 1)[1]
+                names.setdefault(obj_name, set()).update(record.get(attr, []))
+        return dict(
+            (obj_name, rule_obj._map_names(ldap, obj_name, obj_names))
+            for obj_name, obj_names in names.items() if obj_names)
+
+    def _import_rule(self, ldap, record, refs, failed):
+        rule_obj = self.api.Object['deskprofilerule']
+        profile = record['ipadeskprofiletarget']
+        profile_dn = refs.get('deskprofile', {}).get(profile.lower())
+        if profile_dn is None:
+            failed.append(dict(
+                type=u'rule', cn=record['cn'],
+                error=unicode(_('Desktop profile %(rule)s not found')
+                              % dict(rule=profile))))
+            return False
+
+        # Rule names are unique across all rule containers
+        if record['cn'].lower() in refs['rule']:
+            failed.append(dict(
+                type=u'rule', cn=record['cn'],
+                error=unicode(_('%(oname)s with name "%(pkey)s" already '
+                                'exists') % dict(oname=rule_obj.object_name,
+                                                 pkey=record['cn']))))
+            return False
+
+        entry = ldap.make_entry(
+            DN(('cn', record['cn']),
+               refs['container'].get(record.get('container'),
+                                     rule_obj._container_dn())),
+            objectclass=list(rule_obj.object_class),
+            cn=[record['cn']],
+            ipauniqueid=['autogenerate'],
+            ipadeskprofiletarget=[profile_dn],
+            ipadeskprofilepriority=[record['ipadeskprofilepriority']],
+            ipaenabledflag=[
+                'TRUE' if record.get('ipaenabledflag', True) else 'FALSE'],
+        )
+        for attr in ('description', 'usercategory', 'hostcategory'):
+            if record.get(attr):
+                entry[attr] = [record[attr]]
+
+        if record.get('seealso'):
+            hbac_dn = refs.get('hbacrule', {}).get(record['seealso'].lower())
+            if hbac_dn is None:
+                failed.append(dict(
+                    type=u'rule', cn=record['cn'],
+                    error=unicode(_('HBAC rule %(rule)s not found')
+                                  % dict(rule=record['seealso']))))
+                return False
+            entry['seealso'] = [hbac_dn]
+
+        missing = []
+        for attr in RULE_MEMBER_ATTRIBUTES:
+            member_attr, obj_name = attr.split('_', 1)
+            for name in record.get(attr, []):
+                member_dn = refs.get(obj_name, {}).get(name.lower())
+                if member_dn is None:
+                    missing.append(name)
+                else:
+                    entry.setdefault(member_attr, []).append(member_dn)
+
+        try:
+            ldap.add_entry(entry)
+        except errors.ExecutionError as e:
+            failed.append(dict(type=u'rule', cn=record['cn'],
+                               error=unicode(e)))
+            return False
+        refs['rule'].add(record['cn'].lower())
+
+        # Members that do not exist in this realm are skipped, the rule
+        # itself is still imported
+        if missing:
+            failed.append(dict(
+                type=u'rule', cn=record['cn'],
+                error=unicode(_('members not found: %(members)s')
+                              % dict(members=u', '.join(missing)))))
+        return True
+
+
+@register()
+class deskprofilerule_resolve(Command):
+    __doc__ = _('Resolve Desktop Profile Rule Maps applied to users on '
+                'a host or on all hosts of a host group.')
+
+    takes_options = (
+        Str('host?',
+            cli_name='host',
+            label=_('Host'),
+            doc=_('Host to resolve the rules for'),
+        ),
+        Str('hostgroup?',
+            cli_name='hostgroup',
+            label=_('Host Group'),
+            doc=_('Host group to resolve the rules for'),
+        ),
+        Str('user*',
+            cli_name='users',
+            label=_('Users'),
+            doc=_('Users to resolve the rules for (default: all users '
+                  'the rules apply to)'),
+        ),
+        Str('container*',
+            cli_name='containers',
+            label=_('Rule containers'),
+            doc=_('Search only the top-level container and these rule '
+                  'containers (default: all rules)'),
+        ),
+    )
+
+    has_output = (
+        output.Output('result', dict,
+                      _('Rules applied to the users on each host, rule '
+                        'details and profile data')),
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        rule_obj = self.api.Object['deskprofilerule']
+
+        if bool(options.get('host')) == bool(options.get('hostgroup')):
+            raise errors.MutuallyExclusiveError(
+                reason=_('exactly one of host and hostgroup must be set'))
+
+        if options.get('host'):
+            host = options['host']
+            hosts = rule_obj._find_by_names(
+                ldap, 'host', [host], ['fqdn', 'memberof']).values()
+            if not hosts:
+                self.api.Object['host'].handle_not_found(host)
+        else:
+            hostgroup = options['hostgroup']
+            hostgroups = rule_obj._map_names(ldap, 'hostgroup', [hostgroup])
+            if hostgroup.lower() not in hostgroups:
+                self.api.Object['hostgroup'].handle_not_found(hostgroup)
+            hosts = rule_obj._search_chunked(
+                ldap, 'host', 'memberof', [hostgroups[hostgroup.lower()]],
+                ['fqdn', 'memberof'])
+
+        # Candidate rules are read once for all hosts and then matched
+        # against each host in memory
+        host_dns = dict((host.single_value['fqdn'],
+                         rule_obj._member_dns(host)) for host in hosts)
+        all_host_dns = set()
+        for dns in host_dns.values():
+            all_host_dns.update(dns)
+        rules = rule_obj._resolve_host_rules(ldap, all_host_dns,
+                                             options.get('container'))
+
+        if options.get('user'):
+            users = rule_obj._find_by_names(
+                ldap, 'user', options['user'], ['memberof']).values()
+        else:
+            users = rule_obj._resolve_users(ldap, rules)
+
+        # Only DNs referenced by the rules decide whether a rule applies.
+        # Hosts and users with the same referenced DNs share the result,
+        # which keeps the work proportional to the number of distinct
+        # memberships rather than to the number of hosts times users.
+        referenced = dict(memberhost=set(), memberuser=set())
+        for rule, members in rules:
+            for attr, dns in referenced.items():
+                dns.update(DN(value) for value in members.get(attr, []))
+
+        user_keys = dict(
+            (user.single_value['uid'],
+             frozenset(rule_obj._member_dns(user) & referenced['memberuser']))
+            for user in users)
+
+        policies = {}
+        policy_ids = {}
+        host_policies = {}
+        applied = {}
+        for fqdn, dns in host_dns.items():
+            host_key = frozenset(dns & referenced['memberhost'])
+            if host_key not in policy_ids:
+                host_rules = [
+                    (rule, members) for rule, members in rules
+                    if rule_obj._matches(members, 'hostcategory',
+                                         'memberhost', host_key)]
+                by_user_key = {}
+                policy = {}
+                for uid, user_key in user_keys.items():
+                    if user_key not in by_user_key:
+                        by_user_key[user_key] = [
+                            rule for rule, members in host_rules
+                            if rule_obj._matches(members, 'usercategory',
+                                                 'memberuser', user_key)]
+                    policy[uid] = [rule.single_value['cn']
+                                   for rule in by_user_key[user_key]]
+                    for rule in by_user_key[user_key]:
+                        applied[rule.single_value['cn']] = rule
+                policy_ids[host_key] = unicode(len(policies))
+                policies[policy_ids[host_key]] = policy
+            host_policies[fqdn] = policy_ids[host_key]
+
+        return dict(result=dict(
+            hosts=host_policies,
+            policies=policies,
+            rules=dict(
+                (name, dict(
+                    priority=int(rule.single_value['ipadeskprofilepriority']),
+                    profile=DN(
+                        rule.single_value['ipadeskprofiletarget'])[0].value))
+                for name, rule in applied.items()),
+            profiles=rule_obj._resolve_profiles(ldap, applied.values()),
+        ))
+
+
+@register()
+class deskprofilerule_analyze(Command):
+    __doc__ = _('Find Desktop Profile Rule Maps which never contribute to '
+                'applied profiles.')
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict,
+                      _('Unreachable, duplicate, shadowed and conflicting '
+                        'rules')),
+        output.Output('count', int, _('Number of rules that can be removed')),
+    )
+
+    msg_summary = ngettext(
+        '%(count)d Desktop Profile Rule Map can be removed',
+        '%(count)d Desktop Profile Rule Maps can be removed', 0
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        rule_obj = self.api.Object['deskprofilerule']
+
+        entries = rule_obj._find_rules(
+            ldap, '(cn=*)', RESOLVE_ATTRIBUTES + ['ipaenabledflag'])
+
+        # HBAC rules referenced by the rules are read once
+        hbac_names = set(DN(entry.single_value['seealso'])[0].value
+                         for entry in entries if 'seealso' in entry)
+        hbac_rules = dict(
+            (entry.dn, entry) for entry in rule_obj._find_by_names(
+                ldap, 'hbacrule', hbac_names, RESOLVE_ATTRIBUTES).values())
+
+        rules = []
+        for entry in entries:
+            members = entry
+            if 'seealso' in entry:
+                members = hbac_rules.get(DN(entry.single_value['seealso']))
+            enabled = entry.single_value.get('ipaenabledflag', u'TRUE')
+            rule = dict(
+                name=entry.single_value['cn'],
+                enabled=unicode(enabled).upper() == u'TRUE',
+                profile=DN(entry.single_value['ipadeskprofiletarget']),
+                priority=int(entry.single_value['ipadeskprofilepriority']),
+                hbac_missing=members is None,
+                user_all=False, users=frozenset(),
+                host_all=False, hosts=frozenset(),
+            )
+            if members is not None:
+                rule.update(
+                    user_all=bool(is_all(members, 'usercategory')),
+                    users=frozenset(
+                        DN(value) for value in members.get('memberuser', [])),
+                    host_all=bool(is_all(members, 'hostcategory')),
+                    hosts=frozenset(
+                        DN(value) for value in members.get('memberhost', [])),
+                )
+            rules.append(rule)
+
+        report = _analyze_rules(rules)
+        count = sum(len(report[key])
+                    for key in ('unreachable', 'duplicates', 'shadowed'))
+        return dict(result=report, count=count)
+
+
+@register()
+class deskprofilerule_redistribute(Command):
+    __doc__ = _('Move Desktop Profile Rule Maps into rule containers named '
+                'after the top-level host group of their hosts.')
+
+    takes_options = (
+        Flag('flatten',
+            cli_name='flatten',
+            doc=_('Move all rules back to the top-level container and '
+                  'remove empty rule containers'),
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', (list, tuple),
+                      _('Moved rules and their new rule containers')),
+        output.Output('count', int, _('Number of moved rules')),
+    )
+
+    msg_summary = ngettext(
+        '%(count)d Desktop Profile Rule Map moved',
+        '%(count)d Desktop Profile Rule Maps moved', 0
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        rule_obj = self.api.Object['deskprofilerule']
+
+        entries = rule_obj._find_rules(
+            ldap, '(cn=*)', ['cn', 'hostcategory', 'memberhost', 'seealso'])
+        if options.get('flatten'):
+            targets = dict((entry.dn, None) for entry in entries)
+        else:
+            targets = self._get_targets(ldap, entries)
+
+        moved = []
+        containers = {}
+        for entry in entries:
+            container = targets[entry.dn]
+            if container == rule_obj._get_container(entry.dn):
+                continue
+            if container not in containers:
+                containers[container] = rule_obj._ensure_container(
+                    ldap, container)
+            rule_obj._move_rule(
+                ldap, entry.dn, DN(entry.dn[0], containers[container]))
+            moved.append(dict(cn=entry.single_value['cn'],
+                              container=container))
+
+        if options.get('flatten'):
+            self._remove_containers(ldap)
+
+        return dict(result=moved, count=len(moved))
+
+    def _get_targets(self, ldap, entries):
+        """
+        Find the rule container of every rule: the name of the single
+        top-level host group all hosts of the rule belong to. Rules for
+        all hosts, rules based on HBAC rules and rules whose hosts span
+        several top-level host groups belong to the top-level container.
+        """
+        rule_obj = self.api.Object['deskprofilerule']
+        hostgroup_obj = self.api.Object['hostgroup']
+
+        hostgroups = rule_obj._search_chunked(
+            ldap, 'hostgroup', 'objectclass', hostgroup_obj.object_class,
+            ['memberof'])
+        hostgroup_dns = set(entry.dn for entry in hostgroups)
+        parents = dict(
+            (entry.dn, set(DN(value) for value in entry.get('memberof', [])
+                           if DN(value) in hostgroup_dns))
+            for entry in hostgroups)
+        roots = set(dn for dn, dns in parents.items() if not dns)
+
+        host_names = set()
+        for entry in entries:
+            for attr, obj_name, member_dn in rule_obj._classify_members(
+                    entry, ['memberhost']):
+                if obj_name == 'host':
+                    host_names.add(
+                        self.api.Object['host'].get_primary_key_from_dn(
+                            member_dn))
+        hosts = dict(
+            (host.dn, set(DN(value) for value in host.get('memberof', [])))
+            for host in rule_obj._find_by_names(
+                ldap, 'host', host_names, ['memberof']).values())
+
+        targets = {}
+        for entry in entries:
+            targets[entry.dn] = None
+            if 'seealso' in entry or is_all(entry, 'hostcategory'):
+                continue
+            tops = set()
+            for attr, obj_name, member_dn in rule_obj._classify_members(
+                    entry, ['memberhost']):
+                if obj_name == 'host':
+                    tops.update(hosts.get(member_dn, set()) & roots)
+                else:
+                    tops.update((parents.get(member_dn, set()) |
+                                 set([member_dn])) & roots)
+            if len(tops) == 1:
+                targets[entry.dn] = hostgroup_obj.get_primary_key_from_dn(
+                    tops.pop())
+        return targets
+
+    def _remove_containers(self, ldap):
+        rule_obj = self.api.Object['deskprofilerule']
+        try:
+            entries, truncated = ldap.find_entries(
+                ldap.make_filter_from_attr('objectclass', 'nsContainer'),
+                [''], rule_obj._container_dn(), scope=ldap.SCOPE_ONELEVEL)
+        except errors.NotFound:
+            return
+        for entry in entries:
+            try:
+                ldap.delete_entry(entry.dn)
+            except errors.NotAllowedOnNonLeaf:
+                # Entries other than rules were put into the container
+                continue
@@ -0,0 +1,85 @@
+# Copyright (C) 2016  Red Hat
+# see file 'COPYING' for use and warranty information
+"""
+Test the helpers of the deskprofile client plugin.
+
+The plugin has to be installed into the ipaclient.plugins package.
+"""
+
+import pytest
+
+deskprofile = pytest.importorskip('ipaclient.plugins.deskprofile')
+
+
+@pytest.mark.parametrize('priority,rule,name', [
+    (100, u'finance', '000100_finance.json'),
+    (0, u'Visual Design', '000000_Visual_Design.json'),
+    (5, u'tab\tand  spaces', '000005_tab_and__spaces.json'),
+    (42, u'a*b?c[d]e{f}g/h\\i', '000042_abcdefghi.json'),
+])
+def test_profile_file_name(priority, rule, name):
+    assert deskprofile._profile_file_name(priority, rule) == name
+    assert deskprofile.PROFILE_FILE_RE.match(name)
+
+
+def test_profile_file_re():
+    assert not deskprofile.PROFILE_FILE_RE.match('100_finance.json')
+    assert not deskprofile.PROFILE_FILE_RE.match('000100_finance.txt')
+    assert not deskprofile.PROFILE_FILE_RE.match('.000100_finance.json.tmp')
+
+
+@pytest.fixture
+def stage():
+    from ipalib import api
+    return deskprofile.deskprofile_stage(api)
+
+
+def test_stage_user(stage, tmp_path):
+    path = str(tmp_path / 'alice')
+    files = {'000100_finance.json': b'{"a": 1}'}
+    counts = dict(written=0, unchanged=0, removed=0)
+    stage._stage_user(path, 'alice', files, False, counts)
+    assert counts == dict(written=1, unchanged=0, removed=0)
+    target = tmp_path / 'alice' / '000100_finance.json'
+    assert target.read_bytes() == b'{"a": 1}'
+
+    # An unchanged file is not rewritten, a changed one is replaced
+    inode = target.stat().st_ino
+    stage._stage_user(path, 'alice', files, False, counts)
+    assert counts == dict(written=1, unchanged=1, removed=0)
+    assert target.stat().st_ino == inode
+    files['000100_finance.json'] = b'{"a": 2}'
+    stage._stage_user(path, 'alice', files, False, counts)
+    assert counts == dict(written=2, unchanged=1, removed=0)
+    assert target.read_bytes() == b'{"a": 2}'
+
+
+def test_stage_user_removes_stale(stage, tmp_path):
+    user_dir = tmp_path / 'alice'
+    user_dir.mkdir()
+    (user_dir / '000050_old.json').write_bytes(b'{}')
+    (user_dir / 'notes.txt').write_bytes(b'notes')
+    (user_dir / '50_short.json').write_bytes(b'{}')
+    (tmp_path / 'elsewhere.json').write_bytes(b'{}')
+    (user_dir / '000060_link.json').symlink_to(tmp_path / 'elsewhere.json')
+
+    counts = dict(written=0, unchanged=0, removed=0)
+    stage._stage_user(str(user_dir), 'alice',
+                      {'000100_finance.json': b'{}'}, False, counts)
+    assert counts == dict(written=1, unchanged=0, removed=1)
+    assert sorted(p.name for p in user_dir.iterdir()) == [
+        '000060_link.json', '000100_finance.json', '50_short.json',
+        'notes.txt']
+    assert (tmp_path / 'elsewhere.json').exists()
+
+
+def test_remove_stale(stage, tmp_path):
+    (tmp_path / '000100_finance.json').write_bytes(b'{}')
+    (tmp_path / '000200_design.json').write_bytes(b'{}')
+    (tmp_path / 'notes.txt').write_bytes(b'notes')
+
+    counts = dict(written=0, unchanged=0, removed=0)
+    stage._remove_stale(str(tmp_path), {'000200_design.json': b'{}'}, counts)
+    assert counts == dict(written=0, unchanged=0, removed=1)
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        '000200_design.json', 'notes.txt']
@@ -0,0 +1,208 @@
+# Copyright (C) 2016  Red Hat
+# see file 'COPYING' for use and warranty information
+"""
+Test the helpers of the deskprofile server plugin.
+
+The plugin has to be installed into the ipaserver.plugins package.
+"""
+
+import time
+
+import pytest
+
+deskprofile = pytest.importorskip('ipaserver.plugins.deskprofile')
+
+PROFILE1 = u'cn=profile1,cn=profiles,cn=desktop-profile,dc=example,dc=com'
+PROFILE2 = u'cn=profile2,cn=profiles,cn=desktop-profile,dc=example,dc=com'
+
+
+def user(name):
+    return u'uid=%s,cn=users,cn=accounts,dc=example,dc=com' % name
+
+
+def host(name):
+    return u'fqdn=%s,cn=computers,cn=accounts,dc=example,dc=com' % name
+
+
+def rule(name, profile=PROFILE1, priority=100, users=(), hosts=(),
+         user_all=False, host_all=False, enabled=True, hbac_missing=False):
+    return dict(name=name, enabled=enabled, profile=profile,
+                priority=priority, hbac_missing=hbac_missing,
+                user_all=user_all, users=frozenset(user(u) for u in users),
+                host_all=host_all, hosts=frozenset(host(h) for h in hosts))
+
+
+def test_rule_covers():
+    wide = rule(u'wide', users=[u'alice', u'bob'], hosts=[u'a1'])
+    narrow = rule(u'narrow', users=[u'alice'], hosts=[u'a1'])
+    everyone = rule(u'everyone', user_all=True, hosts=[u'a1'])
+    assert deskprofile._rule_covers(wide, narrow)
+    assert not deskprofile._rule_covers(narrow, wide)
+    assert deskprofile._rule_covers(everyone, wide)
+    assert not deskprofile._rule_covers(wide, everyone)
+
+
+def test_unreachable():
+    report = deskprofile._analyze_rules([
+        rule(u'disabled', users=[u'alice'], hosts=[u'a1'], enabled=False),
+        rule(u'hbac', hbac_missing=True),
+        rule(u'nohosts', users=[u'alice']),
+        rule(u'nousers', hosts=[u'a1']),
+    ])
+    assert report['unreachable'] == [
+        dict(rule=u'disabled', reason=u'disabled'),
+        dict(rule=u'hbac', reason=u'HBAC rule not found'),
+        dict(rule=u'nohosts', reason=u'no hosts'),
+        dict(rule=u'nousers', reason=u'no users'),
+    ]
+
+
+def test_duplicates():
+    report = deskprofile._analyze_rules([
+        rule(u'second', users=[u'alice'], hosts=[u'a1']),
+        rule(u'First', users=[u'alice'], hosts=[u'a1']),
+        rule(u'other', priority=200, users=[u'alice'], hosts=[u'a1']),
+    ])
+    assert report['duplicates'] == [
+        dict(rule=u'second', duplicate_of=u'First')]
+    assert report['shadowed'] == []
+    assert report['conflicts'] == []
+
+
+def test_shadowed():
+    report = deskprofile._analyze_rules([
+        rule(u'narrow', users=[u'alice'], hosts=[u'a1']),
+        rule(u'wide', users=[u'alice', u'bob'], hosts=[u'a1']),
+        # Wider on users but narrower on hosts: neither covers the other
+        rule(u'crossed', users=[u'alice', u'bob', u'carol'],
+             hosts=[u'a2']),
+        # Another profile is never shadowed
+        rule(u'profile2', profile=PROFILE2, users=[u'dave'], hosts=[u'a3']),
+    ])
+    assert report['shadowed'] == [dict(rule=u'narrow', shadowed_by=u'wide')]
+    assert report['conflicts'] == []
+
+
+def test_shadowed_by_category_all():
+    report = deskprofile._analyze_rules([
+        rule(u'alice', users=[u'alice'], hosts=[u'a1']),
+        rule(u'everyone', user_all=True, hosts=[u'a1', u'a2']),
+    ])
+    assert report['shadowed'] == [
+        dict(rule=u'alice', shadowed_by=u'everyone')]
+
+
+def test_conflicts_category_all():
+    report = deskprofile._analyze_rules([
+        rule(u'everyone', user_all=True, hosts=[u'a1']),
+        rule(u'alice', profile=PROFILE2, users=[u'alice'], hosts=[u'a1']),
+        rule(u'elsewhere', profile=PROFILE2, users=[u'alice'],
+             hosts=[u'a2']),
+        rule(u'anywhere', profile=PROFILE2, host_all=True, users=[u'bob'],
+             priority=200),
+        rule(u'bob', users=[u'bob'], hosts=[u'a9'], priority=200),
+    ])
+    assert report['conflicts'] == [
+        dict(priority=100, rules=[u'alice', u'everyone']),
+        dict(priority=200, rules=[u'anywhere', u'bob']),
+    ]
+
+
+def test_conflicts_all_users_and_all_hosts():
+    # Rules for all users on some hosts overlap with every rule for all
+    # hosts and some users
+    report = deskprofile._analyze_rules([
+        rule(u'users1', user_all=True, hosts=[u'a1']),
+        rule(u'users2', user_all=True, hosts=[u'a2']),
+        rule(u'hosts1', profile=PROFILE2, host_all=True, users=[u'bob']),
+        rule(u'hosts2', host_all=True, users=[u'carol']),
+    ])
+    assert report['conflicts'] == [
+        dict(priority=100, rules=[u'hosts1', u'users1', u'users2'])]
+
+
+def test_conflicts_are_grouped():
+    report = deskprofile._analyze_rules([
+        rule(u'a', users=[u'alice'], hosts=[u'a1']),
+        rule(u'b', profile=PROFILE2, users=[u'alice', u'bob'],
+             hosts=[u'a1', u'a2']),
+        rule(u'c', users=[u'bob'], hosts=[u'a2']),
+        rule(u'd', profile=PROFILE2, users=[u'carol'], hosts=[u'a3']),
+    ])
+    assert report['conflicts'] == [
+        dict(priority=100, rules=[u'a', u'b', u'c'])]
+
+
+def test_conflicts_universal():
+    report = deskprofile._analyze_rules([
+        rule(u'universal', user_all=True, host_all=True),
+        rule(u'alice', profile=PROFILE2, users=[u'alice'], hosts=[u'a1']),
+        rule(u'bob', profile=PROFILE2, users=[u'bob'], hosts=[u'a2']),
+        rule(u'other', profile=PROFILE2, users=[u'bob'], hosts=[u'a2'],
+             priority=200),
+    ])
+    assert report['conflicts'] == [
+        dict(priority=100, rules=[u'alice', u'bob', u'universal'])]
+
+
+def test_universal_same_profile():
+    report = deskprofile._analyze_rules([
+        rule(u'universal', user_all=True, host_all=True),
+        rule(u'alice', users=[u'alice'], hosts=[u'a1']),
+    ])
+    assert report['shadowed'] == [
+        dict(rule=u'alice', shadowed_by=u'universal')]
+    assert report['conflicts'] == []
+
+    report = deskprofile._analyze_rules([
+        rule(u'universal1', user_all=True, host_all=True),
+        rule(u'universal2', profile=PROFILE2, user_all=True, host_all=True),
+    ])
+    assert report['conflicts'] == [
+        dict(priority=100, rules=[u'universal1', u'universal2'])]
+
+
+@pytest.mark.parametrize('make_rule', [
+    # Rules for one user each, every rule is compared with the kept ones
+    lambda i: rule(u'rule%d' % i, users=[u'user%d' % i], hosts=[u'a1']),
+    # Rules for one group on distinct hosts, every rule shares the group
+    lambda i: rule(u'rule%d' % i, profile=(PROFILE1, PROFILE2)[i % 2],
+                   users=[u'group'], hosts=[u'host%d' % i]),
+])
+def test_analyze_scales(make_rule):
+    # Comparing every pair of 20000 rules takes minutes
+    rules = [make_rule(i) for i in range(20000)]
+    start = time.time()
+    report = deskprofile._analyze_rules(rules)
+    assert time.time() - start < 10
+    assert report['shadowed'] == []
+    assert report['conflicts'] == []
+
+
+def test_merge_profile_data():
+    base = {u'a': 1, u'b': {u'c': 2, u'd': 3}, u'e': [1, 2]}
+    delta = {u'a': None, u'b': {u'c': None, u'f': 4}, u'e': [3]}
+    assert deskprofile._merge_profile_data(base, delta) == {
+        u'b': {u'd': 3, u'f': 4}, u'e': [3]}
+    # The parent document is left unchanged
+    assert base == {u'a': 1, u'b': {u'c': 2, u'd': 3}, u'e': [1, 2]}
+
+
+def test_merge_profile_data_without_base():
+    delta = {u'a': None, u'b': {u'c': None, u'd': 1}}
+    assert deskprofile._merge_profile_data(None, delta) == {u'b': {u'd': 1}}
+    assert deskprofile._merge_profile_data([1], delta) == {u'b': {u'd': 1}}
+    assert deskprofile._merge_profile_data({u'a': 1}, [2]) == [2]
+
+
+def test_merge_profile_data_keyed_lists():
+    base = [{u'key': u'x', u'value': 1}, {u'key': u'y', u'value': 2}]
+    delta = [{u'key': u'y', u'value': 3}, {u'key': u'z', u'value': 4}]
+    assert deskprofile._merge_profile_data(base, delta) == [
+        {u'key': u'x', u'value': 1},
+        {u'key': u'y', u'value': 3},
+        {u'key': u'z', u'value': 4},
+    ]
+    # Lists of other items are replaced
+    assert deskprofile._merge_profile_data(
+        base, [{u'value': 5}]) == [{u'value': 5}]
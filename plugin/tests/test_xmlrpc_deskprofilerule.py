@@ -0,0 +1,73 @@
+# Copyright (C) 2016  Red Hat
+# see file 'COPYING' for use and warranty information
+"""
+Test the deskprofilerule commands against an IPA server with the plugin
+installed.
+"""
+
+import pytest
+
+xmlrpc_test = pytest.importorskip('ipatests.test_xmlrpc.xmlrpc_test')
+
+from ipalib import api
+
+PROFILE = u'testprofile'
+RULE = u'testrule'
+SITE_RULE = u'testsiterule'
+RENAMED_RULE = u'testsiterule2'
+CONTAINER = u'testsite'
+HOST = u'testdeskhost1'
+
+
+@pytest.mark.tier1
+class test_deskprofilerule(xmlrpc_test.XMLRPC_test):
+    @classmethod
+    def setup_class(cls):
+        super(test_deskprofilerule, cls).setup_class()
+        cls.fqdn = u'%s.%s' % (HOST, api.env.domain)
+        api.Command.host_add(cls.fqdn, force=True)
+        api.Command.deskprofile_add(PROFILE, ipadeskdata=b'{}')
+        api.Command.deskprofilerule_add(
+            RULE, ipadeskprofiletarget=PROFILE, ipadeskprofilepriority=100)
+
+    @classmethod
+    def teardown_class(cls):
+        for command, name in (('deskprofilerule_del', RULE),
+                              ('deskprofilerule_del', SITE_RULE),
+                              ('deskprofilerule_del', RENAMED_RULE),
+                              ('deskprofile_del', PROFILE),
+                              ('host_del', cls.fqdn)):
+            try:
+                api.Command[command](name)
+            except Exception:
+                pass
+        super(test_deskprofilerule, cls).teardown_class()
+
+    def test_add_host_by_short_name(self):
+        result = api.Command.deskprofilerule_add_host(RULE, host=[HOST])
+        assert result['completed'] == 1
+        assert not result['failed']['memberhost']['host']
+        assert list(result['result']['memberhost_host']) == [self.fqdn]
+
+        # Adding the host again reports it as a member already
+        result = api.Command.deskprofilerule_add_host(RULE, host=[self.fqdn])
+        assert result['completed'] == 0
+        assert len(result['failed']['memberhost']['host']) == 1
+
+    def test_move_and_rename_in_container(self):
+        api.Command.deskprofilerule_add(
+            SITE_RULE, ipadeskprofiletarget=PROFILE,
+            ipadeskprofilepriority=200)
+        result = api.Command.deskprofilerule_mod(
+            SITE_RULE, container=CONTAINER)
+        assert result['result']['container'][0] == CONTAINER
+
+        # A renamed rule stays in its container
+        result = api.Command.deskprofilerule_mod(
+            SITE_RULE, rename=RENAMED_RULE)
+        assert result['result']['cn'][0] == RENAMED_RULE
+        assert result['result']['container'][0] == CONTAINER
+        result = api.Command.deskprofilerule_show(RENAMED_RULE)
+        assert result['result']['container'][0] == CONTAINER
+        assert api.Command.deskprofilerule_find(
+            cn=SITE_RULE)['count'] == 0